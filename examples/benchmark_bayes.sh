@@ -0,0 +1,23 @@
+# !/bin/sh
+##Times calculate_bayes.py with --workers from 1 up to 32 on the matched tables made by
+##timing.sh (run that first), and checks every run gives exactly the same output as
+##the run with one worker
+BASE_TIME=0
+for WORKERS in 1 2 4 8 16 32
+do
+	START_TIME=$(date +%s.%N)
+	calculate_bayes.py --primary_cat=mwacs --matched_cats=vlssr,mrc,sumss,nvss \
+		--primary_freq=180 --matched_freqs=74,408,843,1400 \
+		--out_name=bayes_mwacs-v-m-s-n_w$WORKERS.txt --workers=$WORKERS > /dev/null
+	END_TIME=$(date +%s.%N)
+	ELAPSED=$(python -c "print '%.2f' %($END_TIME - $START_TIME)")
+	if [ $WORKERS -eq 1 ]; then BASE_TIME=$ELAPSED; fi
+	SPEED_UP=$(python -c "print '%.2f' %($BASE_TIME / $ELAPSED)")
+	if cmp -s bayes_mwacs-v-m-s-n_w1.txt bayes_mwacs-v-m-s-n_w$WORKERS.txt
+	then
+		SAME="identical"
+	else
+		SAME="DIFFERENT"
+	fi
+	echo "Workers: $WORKERS Time: $ELAPSED Speed up: $SPEED_UP Output: $SAME"
+done
@@ -0,0 +1,55 @@
+# !/bin/sh
+##Times the friends-of-friends grouping in cross_match.py on the MWACS to VLSSr
+##and MRC example from timing.sh (all three catalogues are in original_cats),
+##and checks the groups against the connected components found by scipy from
+##the same matched pairs. --pairs is used so that every pair is known by the
+##row of each source, which is what groups_mwacs.fits records too
+START_TIME=$SECONDS
+cross_match.py --separation=180 --cache_dir=puma_cache --groups --pairs \
+	--table1=$PUMA_DIR/original_cats/vizier_mwacs.fits \
+	--details1=MWACS,RAJ2000,e_RAJ2000,DEJ2000,e_DEJ2000,180,S180,e_S180,PA,Maj,Min,cmp,ID_S \
+	--units1=deg,arcmin,deg,arcmin,Jy,Jy,deg,arcmin,arcmin \
+	--ra_lims1=0,100 \
+	--dec_lims1=-55,-20 \
+	--prefix1=mwacs \
+	--table2=$PUMA_DIR/original_cats/vlssr_names.fits \
+	--details2=Name,RA_J2000,RA_err,DEC_J2000,DEC_err,74,Flux,Flux_err,PA,major,minor,Flags,Field \
+	--units2=deg,deg,deg,deg,Jy,Jy,deg,arcsec,arcsec \
+	--ra_lims2=0,140 \
+	--dec_lims2=-20,40 \
+	--prefix2=vlssr \
+	--table2=$PUMA_DIR/original_cats/vizier_mrc.fits \
+	--details2=MRC,_RAJ2000,e_RA2000,_DEJ2000,e_DE2000,408,S408,e_S408,-,-,-,Mflag,- \
+	--units2=deg,sec,deg,arcsec,Jy,Jy,-,-,- \
+	--ra_lims2=150,250 \
+	--dec_lims2=-30,10 \
+	--prefix2=mrc
+STRING_1="Time to match and group vlssr and mrc: "
+TIME_1=$SECONDS
+ELAPSED_1=$(($TIME_1 - $START_TIME))
+PRINT_1=$STRING_1$ELAPSED_1
+##-------------------------------------------------------------------------------------------------
+##Check the groups are the connected components of the matched pairs. Sources
+##are identified by catalogue and row, as names need not be unique
+python -c "
+from astropy.io import fits
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import numpy as np
+import time
+groups = fits.open('groups_mwacs.fits')[1].data
+nodes = dict([((cat,row),ind) for ind,(cat,row) in enumerate(zip(groups['Catalogue'],groups['Row']))])
+links1,links2 = [],[]
+for cat in ['vlssr','mrc']:
+	ind1 = np.load('pairs_mwacs_%s/ind1.npy' %cat)
+	ind2 = np.load('pairs_mwacs_%s/ind2.npy' %cat)
+	links1 += [nodes[('mwacs',row)] for row in ind1]
+	links2 += [nodes[(cat,row)] for row in ind2]
+start = time.time()
+graph = coo_matrix((np.ones(len(links1)),(links1,links2)),shape=(len(nodes),len(nodes)))
+num_groups,labels = connected_components(graph,directed=False)
+print 'scipy found %d groups from %d pairs in %.3fs' %(num_groups,len(links1),time.time()-start)
+same = len(set(zip(labels,groups['GroupID'])))==num_groups==len(set(groups['GroupID']))
+print 'Identical groups: %s, largest group: %d sources' %(same,groups['GroupSize'].max())
+"
+echo $PRINT_1
@@ -0,0 +1,62 @@
+# !/bin/sh
+##Compares the native sky matcher in cross_match.py against stilts tmatch2,
+##using the MWACS to MRC example from timing.sh (both catalogues are in
+##original_cats). Both runs should produce the same matched_mwacs_mrc.fits,
+##so a copy of the stilts output is kept to compare against
+START_TIME=$SECONDS
+cross_match.py --separation=180 --matcher=stilts \
+	--table1=$PUMA_DIR/original_cats/vizier_mwacs.fits \
+	--details1=MWACS,RAJ2000,e_RAJ2000,DEJ2000,e_DEJ2000,180,S180,e_S180,PA,Maj,Min,cmp,ID_S \
+	--units1=deg,arcmin,deg,arcmin,Jy,Jy,deg,arcmin,arcmin \
+	--ra_lims1=0,100 \
+	--dec_lims1=-55,-20 \
+	--prefix1=mwacs \
+	--table2=$PUMA_DIR/original_cats/vizier_mrc.fits \
+	--details2=MRC,_RAJ2000,e_RA2000,_DEJ2000,e_DE2000,408,S408,e_S408,-,-,-,Mflag,- \
+	--units2=deg,sec,deg,arcsec,Jy,Jy,-,-,- \
+	--ra_lims2=150,250 \
+	--dec_lims2=-30,10 \
+	--prefix2=mrc
+mv matched_mwacs_mrc.fits matched_mwacs_mrc_stilts.fits
+STRING_1="Time to match mrc with stilts: "
+TIME_1=$SECONDS
+ELAPSED_1=$(($TIME_1 - $START_TIME))
+PRINT_1=$STRING_1$ELAPSED_1
+##-------------------------------------------------------------------------------------------------
+cross_match.py --separation=180 --matcher=native \
+	--table1=$PUMA_DIR/original_cats/vizier_mwacs.fits \
+	--details1=MWACS,RAJ2000,e_RAJ2000,DEJ2000,e_DEJ2000,180,S180,e_S180,PA,Maj,Min,cmp,ID_S \
+	--units1=deg,arcmin,deg,arcmin,Jy,Jy,deg,arcmin,arcmin \
+	--ra_lims1=0,100 \
+	--dec_lims1=-55,-20 \
+	--prefix1=mwacs \
+	--table2=$PUMA_DIR/original_cats/vizier_mrc.fits \
+	--details2=MRC,_RAJ2000,e_RA2000,_DEJ2000,e_DE2000,408,S408,e_S408,-,-,-,Mflag,- \
+	--units2=deg,sec,deg,arcsec,Jy,Jy,-,-,- \
+	--ra_lims2=150,250 \
+	--dec_lims2=-30,10 \
+	--prefix2=mrc
+STRING_2="Time to match mrc natively: "
+TIME_2=$SECONDS
+ELAPSED_2=$(($TIME_2 - $TIME_1))
+PRINT_2=$STRING_2$ELAPSED_2
+##-------------------------------------------------------------------------------------------------
+##Check both matchers found the same pairs with the same separations
+python -c "
+from astropy.io import fits
+import numpy as np
+import os
+if not os.path.exists('matched_mwacs_mrc_stilts.fits'):
+	print 'No stilts output to compare against - is stilts installed?'
+else:
+	stilts = fits.open('matched_mwacs_mrc_stilts.fits')[1].data
+	native = fits.open('matched_mwacs_mrc.fits')[1].data
+	pairs_stilts = sorted(zip(stilts['mwacs_name'],stilts['mrc_name'],stilts['Separation']))
+	pairs_native = sorted(zip(native['mwacs_name'],native['mrc_name'],native['Separation']))
+	print 'Pairs found by stilts: %d, natively: %d' %(len(pairs_stilts),len(pairs_native))
+	same = [p[0]==n[0] and p[1]==n[1] for p,n in zip(pairs_stilts,pairs_native)]
+	max_diff = max([abs(p[2]-n[2]) for p,n in zip(pairs_stilts,pairs_native)] + [0.0])
+	print 'Identical pairs: %s, largest separation difference: %.2e arcsec' %(all(same) and len(same)==len(pairs_stilts)==len(pairs_native),max_diff)
+"
+echo $PRINT_1
+echo $PRINT_2
@@ -2,10 +2,14 @@
 import atpy
 import numpy as np
 import optparse
-try:
-	import pyfits as fits
-except ImportError:
-	from astropy.io import fits
+import os
+import hashlib
+import time
+import cross_match_lib as cml
+import table_access_lib as tal
+import calculate_bayes_lib as cbl
+import group_store_lib as gsl
+from multiprocessing import Pool
 
 ##Get all of the input variables
 parser = optparse.OptionParser()
@@ -25,6 +29,27 @@ parser.add_option('-f', '--matched_freqs',
 parser.add_option('-o', '--out_name', 
 	help='Enter name of output matched group file')
 	
+parser.add_option('-b', '--batch_size', default=1000, type='int',
+	help='Number of groups to calculate the posteriors of at once (default 1000)')
+	
+parser.add_option('-t', '--posterior_floor', default=0.0, type='float',
+	help='Leave out any combination with a posterior below this (default 0.0, keep everything)')
+	
+parser.add_option('-c', '--max_combinations', default=100000, type='int',
+	help='Most combinations to keep for any one group - groups with more are truncated, and listed in <out_name>_truncated.txt (default 100000)')
+	
+parser.add_option('-s', '--store', action='store_true', default=False,
+	help='Add --store to write the groups to a binary group store (a directory called out_name) instead of text')
+	
+parser.add_option('-w', '--workers', default=1, type='int',
+	help='Add --workers=N to score the groups in N processes. The output is the same as with one')
+	
+parser.add_option('-r', '--stream', action='store_true', default=False,
+	help='Add --stream to merge the matched tables by primary name and make, score and write a batch of groups at a time, so the sources and groups are never all held at once. Groups are written in order of primary name. Memory still grows with the number of rows, but only by the primary name and row number of every row kept for the merge, and the matched names and separations read once to find repeated sources')
+	
+parser.add_option('-k', '--cache',
+	help='Enter name of a score cache (a directory). Any group whose sources have not changed since the cache was written reuses the scores from it, and the cache is then rewritten with every group of this run')
+	
 options, args = parser.parse_args()
 
 ##Make all of the information usable
@@ -33,417 +58,470 @@ primary_freq = options.primary_freq
 matched_cats = options.matched_cats.split(',')
 matched_freqs = options.matched_freqs.split(',')
 
-num_freqs = [len(primary_cat.split('~'))]
-for freq in matched_freqs: num_freqs.append(len(freq.split('~')))
-num_freqs = map(int,num_freqs)
-
 out_name = options.out_name
+batch_size = options.batch_size
+posterior_floor = options.posterior_floor
+max_combinations = options.max_combinations
+workers = options.workers
+store = options.store
+stream = options.stream
+cache_name = options.cache
+##Make a list of all catalogues, in the order they appear in the matched tables, and
+##the frequencies of each
+all_cats = [primary_cat] + matched_cats
+all_freqs = [[primary_freq]] + [freq.split('~') for freq in matched_freqs]
+max_freqs = max([len(freqs) for freqs in all_freqs])
+##With more than one worker, how many runs of groups to give each worker, so
+##that one slow run doesn't hold up the rest
+chunks_per_worker = 4
 
-dr = np.pi/180.0
-
-##Opens each indivudual vot match table
+##Opens each indivudual vot match table through table_access_lib, so columns are
+##only read when needed, and only once however many times the table is opened.
+##If cross_match.py was run with --pairs, there is a pairs_*/ store instead, and
+##the matched columns are indexed straight out of the stores from that
 def open_table(name):
-	table = fits.open(name)
-	data = table[1].data
-	shape = data.shape
-	rows = shape[0]
-	nu_1 = table[1].header['nu_1']
-	nu_2 = table[1].header['nu_2']
+	pairs_dir = name.replace('matched_','pairs_',1).replace('.fits','')
+	if name not in tal.open_tables and not os.path.exists(name) and os.path.exists(os.path.join(pairs_dir,'meta.json')):
+		tal.open_tables[name] = cml.pairs_table(name,pairs_dir)
+	table = tal.open_table(name)
+	rows = table.rows
+	nu_1 = table.header['nu_1']
+	nu_2 = table.header['nu_2']
 	
-	return data,rows,nu_1,nu_2
-
-##A class to store the information for a group of matched sources
-class source_info:
-	def __init__(self):
-		self.cats = []
-		self.names = []
-		self.ras = []
-		self.rerrs = []
-		self.decs = []
-		self.derrs = []
-		self.freqs = []
-		self.fluxs = []
-		self.ferrs = []
-		self.majors = []
-		self.minors = []
-		self.PAs = []
-		self.flags = []
-		self.IDs = []
+	return table,rows,nu_1,nu_2
 
-##A class to store the information for a single source
-class source_single:
+##A class to store the information for a set of sources as arrays, with one entry per
+##source. cat is the number of each source's catalogue in all_cats, the positions, errors
+##and shapes are floats, and flux and ferr are (sources x frequencies) blocks with one
+##column for each frequency, padded with -100000.0 for catalogues with fewer than max_freqs
+class source_arrays:
 	def __init__(self):
-		self.cat = []
+		self.cat = None
 		self.name = None
-		self.ras = None
+		self.ra = None
 		self.rerr = None
 		self.dec = None
 		self.derr = None
-		self.freqs = []
-		self.fluxs = []
-		self.ferrs = []
+		self.flux = None
+		self.ferr = None
 		self.major = None
 		self.minor = None
 		self.PA = None
 		self.flag = None
 		self.ID = None
-		
+		self.nu = None
+
+source_fields = ['cat','name','ra','rerr','dec','derr','flux','ferr','major','minor','PA','flag','ID','nu']
+
+##Returns the sources at inds (an array of indexes or a slice) of a source_arrays
+def take_sources(sources,inds):
+	taken = source_arrays()
+	for field in source_fields:
+		setattr(taken,field,getattr(sources,field)[inds])
+	return taken
+
+##Joins a list of source_arrays into one, in order
+def join_sources(all_sources):
+	joined = source_arrays()
+	for field in source_fields:
+		setattr(joined,field,np.concatenate([getattr(sources,field) for sources in all_sources]))
+	return joined
+
 ##The way STILTS is run in cross_match.py means sources in the matched catalogues
 ##may be matched to more than one base catalogue source. Read through all the matches
 ##and check for any repeated matched sources; if they exist, choose the match with the 
 ##smallest angular separation. Delete the other matched row
 
-##Will contain lists of rows to be skipped that correspond to each catalogue in matched_cats
+##Will contain boolean arrays of rows to be skipped that correspond to each catalogue in matched_cats
 skip_rows = []
 
-for cat in matched_cats:
-	match_names = []
-	separations = []
-	skip_row = []
-	##Get data
-	match_name = 'matched_%s_%s.fits' %(primary_cat,cat)
-	data,rows,nu_1,nu_2 = open_table(match_name)
-	for row in data:
-		match_names.append(str(row[12]))
-		separations.append(float(row[-1]))
-	
-	##Find repeated names. Should only have one match within each STITLS cross match
-	repeat_names = [name for name in set(match_names) if match_names.count(name)>1]
-	
-	##Find the list index number for each repeated source
-	repeat_lists = []
-	for name in repeat_names:
-		repeat_list = []
-		for i in xrange(len(match_names)):
-			if match_names[i] == name: repeat_list.append(i)
-		repeat_lists.append(repeat_list)
-	
-	##For each repeated source, retain the smallest separation, and note the other
-	##row numbers to skip when reading in the main data
-	for ls in repeat_lists:
-		seps = [separations[ind] for ind in ls]
-		keep_ind = ls[seps.index(min(seps))]
-		for ind in ls:
-			if ind != keep_ind: skip_row.append(ind)
-	skip_rows.append(skip_row)
-	
-primary_names = []
-source_matches = []
 scaled_source_nums = []
 
-##Read in the data. First, check each match for a new primary catalogue entry. If new, create a new
-##source_info class and append primary cat information
-for cat,skip in zip(matched_cats,skip_rows):
+##A class to store everything needed from each matched table. The primary and matched
+##source information is held as a source_arrays each, with one entry per row of the table
+class match_info:
+	def __init__(self):
+		self.cat = None
+		self.table = None
+		self.primary = None
+		self.match = None
+
+##Reads the information for one catalogue from a matched table, starting at column
+##start, into a source_arrays with an entry per row. data is the table, or some rows of it
+##(e.g. from table[rows]) with column names names. Every column is read once as an array,
+##and any zero or negative errors swapped for the mean error of that column, or the means of
+##the whole table in means (rerr, derr and ferr) if given. nu is the scaled source density
+##to give each source if the table has no local one
+def read_sources(data,names,start,cat,freqs,nu,means=None):
+	cols = [data[name] for name in names]
+	num_rows = len(cols[0])
+	if means is None: means = [np.mean(cols[start+ind]) for ind in [2,4,6]]
+	sources = source_arrays()
+	sources.cat = np.zeros(num_rows,dtype=np.int16) + all_cats.index(cat)
+	sources.name = cbl.column_strings(cols[start])
+	sources.ra = cbl.text_values(cols[start+1])
+	sources.rerr = cbl.proxy_errors(cols[start+2],means[0])
+	sources.dec = cbl.text_values(cols[start+3])
+	sources.derr = cbl.proxy_errors(cols[start+4],means[1])
+	sources.major = cbl.text_values(cols[start+7])
+	sources.minor = cbl.text_values(cols[start+8])
+	sources.PA = cbl.text_values(cols[start+9])
+	##Sometimes the flag data is empty - need to change to a null
+	##result, otherwise goes as a space and later indexing gets ruined
+	sources.flag = cbl.null_flags(cols[start+10])
+	sources.ID = cbl.null_flags(cols[start+11])
+	##If cross_match.py was run with --density_cell, every source has its own local
+	##scaled source density to use instead of the catalogue wide one
+	if '%s_nu' %cat in names:
+		sources.nu = np.asarray(data['%s_nu' %cat],dtype=float)
+	else:
+		sources.nu = np.zeros(num_rows) + nu
+	
+	##The flux errors are all swapped for the mean of the first flux error
+	ferr_avg = means[2]
+	fluxs = [cbl.text_values(cols[start+5])]
+	ferrs = [cbl.proxy_errors(cols[start+6],ferr_avg,flux=True)]
+	##If the catalogue has more than one frequency, the extra fluxes are after the
+	##primary and matched columns
+	for i in xrange(len(freqs)-1):
+		fluxs.append(cbl.text_values(cols[24+(2*i)]))
+		ferrs.append(cbl.proxy_errors(cols[25+(2*i)],ferr_avg,flux=True))
+	sources.flux = np.zeros((num_rows,max_freqs)) + float(gsl.null)
+	sources.ferr = np.zeros((num_rows,max_freqs)) + float(gsl.null)
+	sources.flux[:,:len(freqs)] = np.transpose(fluxs)
+	sources.ferr[:,:len(freqs)] = np.transpose(ferrs)
+	return sources
+
+##Joins the sources of some matched tables on to groups, one per primary source, with
+##cbl.assemble_groups. infos holds the primary and matched source_arrays of each table,
+##primary_names the primary name of each of their rows, and skips the rows to leave out.
+##Returns all the groups held in one source_arrays, group by group, and the source each
+##group starts at
+def make_groups(infos,primary_names,skips,by_name=False):
+	group_tables,group_rows,is_primary,offsets = cbl.assemble_groups(primary_names,skips,by_name=by_name)
+	all_sources = [sources for info in infos for sources in info]
+	block_starts = np.cumsum([0] + [len(sources.name) for sources in all_sources])
+	return take_sources(join_sources(all_sources),block_starts[2*group_tables + ~is_primary] + group_rows),offsets
+
+##Read in the data from each matched table, in one pass over each. Every column
+##needed is read once, and then repeated sources and groups are found from those.
+##With --stream, only the primary names are kept, sorted, with the rows they are
+##on, and the sources are read in batches as the tables are merged. Those keys,
+##and the columns find_repeats needs, are still one entry per row
+match_infos = []
+for cat in matched_cats:
 	match_name = 'matched_%s_%s.fits' %(primary_cat,cat)
 	
 	###Find the source densities from the tables that were calcualted by cross_match.py,
 	###and add to scaled_source_nums list
-	data,rows,prim_dens,match_dens = open_table(match_name)
+	info = match_info()
+	info.cat = cat
+	info.table,rows,prim_dens,match_dens = open_table(match_name)
 	
 	if len(scaled_source_nums)==0:
 		scaled_source_nums.append(prim_dens)
 		scaled_source_nums.append(match_dens)
 	else:
 		scaled_source_nums.append(match_dens)
-	##If any of the errors are negative or zero, the whole match stops and fails - 
-	##take an average of rerr, derr and ferr here, and subsitute that in later if
-	##needs be
-	base_rerr_avg = np.mean(data['%s_e_RAJ2000' %primary_cat])
-	base_derr_avg = np.mean(data['%s_e_DEJ2000' %primary_cat])
-	base_ferr_avg = np.mean(data['%s_e_S%d' %(primary_cat,float(primary_freq))])
 	
-	cat_rerr_avg = np.mean(data['%s_e_RAJ2000' %cat])
-	cat_derr_avg = np.mean(data['%s_e_DEJ2000' %cat])
-	cat_ferr_avg = np.mean(data['%s_e_S%d' %(cat,float(matched_freqs[matched_cats.index(cat)].split('~')[0]))])
-	##(For all rows of data)
-	for s_row in xrange(rows):
-		##If in the skip list, it's a repeated source, so don't add it to the matched data
-		if s_row in skip:
-			pass
-		else:
-			row = data[s_row]
-			primary_name = row[0]
-			if primary_name not in primary_names:
-				primary_names.append(primary_name)
-				src = source_info()
-				src.cats.append(primary_cat)
-				src.names.append(str(row[0]))
-				src.ras.append(str(row[1]))
-				src.decs.append(str(row[3]))
-				src.fluxs.append(str(row[5]))
-				##Test the errors for zero or neg values,
-				##and insert a proxy error if so
-				if float(row[2])<=0.0:
-					src.rerrs.append(str(base_rerr_avg))
-				else:
-					src.rerrs.append(str(row[2]))
-				
-				if float(row[4])<=0.0:
-					src.derrs.append(str(base_derr_avg))
-				else:
-					src.derrs.append(str(row[4]))
-				
-				if -100000.0<float(row[6])<=0.0:
-					src.ferrs.append(str(base_ferr_avg))
-				else:
-					src.ferrs.append(str(row[6]))
-				src.majors.append(str(row[7]))
-				src.minors.append(str(row[8]))
-				src.PAs.append(str(row[9]))
-				##Sometimes the flag data is empty - need to change to a null
-				##result, otherwise goes as a space and later indexing gets ruined
-				if str(row[10])=='':
-					src.flags.append('-100000.0')
-				elif str(row[10])=='--':
-					src.flags.append('-100000.0')
-				else:
-					src.flags.append(str(row[10]))
-				if str(row[11])=='':
-					src.IDs.append('-100000.0')
-				elif str(row[11])=='--':
-					src.IDs.append('-100000.0')
-				else:
-					src.IDs.append(str(row[11]))
-				src.freqs.append(primary_freq)
-				source_matches.append(src)
+	##With --stream, whole columns are only needed once, so they are read through a slice
+	##of the whole table, which doesn't keep them
+	if stream:
+		columns = info.table[0:info.table.rows]
+	else:
+		columns = info.table
 	
-	##Second, get all the matched source data, and append to the appropriate
-	##primary catalogue source
-	for s_row in xrange(rows):
-		##If in the skip list, it's a repeated source, so don't add it to the matched data
-		if s_row in skip:
-			pass
-		else:
-			row = data[s_row]
-			primary_name = row[0]
-			ind = primary_names.index(primary_name)
-			src = source_matches[ind]
-			src.cats.append(cat)
-			src.names.append(str(row[12]))
-			src.ras.append(str(row[13]))
-			src.decs.append(str(row[15]))
-			##Test the errors for zero or neg values,
-			##and insert a proxy error if so
-			if float(row[14])<=0.0:
-					src.rerrs.append(str(cat_rerr_avg))
-			else:
-				src.rerrs.append(str(row[14]))
-			
-			if float(row[16])<=0.0:
-				src.derrs.append(str(cat_derr_avg))
-			else:
-				src.derrs.append(str(row[16]))
-			src.majors.append(str(row[19]))
-			src.minors.append(str(row[20]))
-			src.PAs.append(str(row[21]))
-			##Sometimes the flag data is empty - need to change to a null
-			##result, otherwise goes as a space and later indexing gets ruined
-			if str(row[22])=='':
-				src.flags.append('-100000.0')
-			elif str(row[22])=='--':
-				src.flags.append('-100000.0')
-			else:
-				src.flags.append(str(row[22]))
-			if str(row[23])=='':
-				src.IDs.append('-100000.0')
-			elif str(row[23])=='--':
-				src.IDs.append('-100000.0')
-			else:
-				src.IDs.append(str(row[23]))
-			ind_freq = matched_cats.index(cat)
-			cat_freq = matched_freqs[ind_freq]
-			cat_freqs = cat_freq.split('~')
-			##If the catalogue has more than one frequency, append all entries to a list
-			##If just one, create a one entry list
-			if len(cat_freqs)>1:
-				freqss = []
-				fluxss = []
-				ferrss = []
-				freqss.append(str(cat_freqs[0]))
-				fluxss.append(str(row[17]))
-				if -100000.0<float(row[18])<=0.0:
-					ferrss.append(str(cat_ferr_avg))
-				else:
-					ferrss.append(str(row[18]))
-				for i in xrange(len(cat_freqs)-1):
-					freqss.append(str(cat_freqs[i+1]))
-					fluxss.append(str(row[24+(2*i)]))
-					if -100000.0<float(row[25+(2*i)])<=0.0:
-						ferrss.append(str(cat_ferr_avg))
-					else:
-						ferrss.append(str(row[25+(2*i)]))
-					
-				src.fluxs.append(fluxss)
-				src.freqs.append(freqss)
-				src.ferrs.append(ferrss)
-				
-				#print freqss
-				#print fluxss
-				#print ferrss
-				
-				
+	##Find repeated names, retaining the smallest separation for each, and note
+	##the other row numbers to skip when making the groups
+	skip_row,num_repeated = cbl.find_repeats(columns[info.table.names[12]],columns['Separation'])
+	print '%d %s sources matched to more than one %s source (%d rows dropped)' %(num_repeated,cat,primary_cat,np.count_nonzero(skip_row))
+	skip_rows.append(skip_row)
+	
+	##If any of the errors are negative or zero, the whole match stops and fails - 
+	##take an average of rerr, derr and ferr, and subsitute that in here
+	if stream:
+		names = info.table.names
+		info.primary_means = [np.mean(columns[names[ind]]) for ind in [2,4,6]]
+		info.match_means = [np.mean(columns[names[ind]]) for ind in [14,16,18]]
+		##Sort the rows that aren't skipped by primary name, keeping the row order
+		##for each name. If the table is already in that order, there's no sort, and
+		##with no rows skipped either the rows are read in runs
+		kept = np.flatnonzero(~skip_row)
+		keys = columns[names[0]][kept]
+		if not np.all(keys[:-1]<=keys[1:]):
+			sort = np.argsort(keys,kind='mergesort')
+			keys,kept = keys[sort],kept[sort]
+		elif len(kept)==info.table.rows:
+			kept = None
+		info.keys,info.order = keys,kept
+	else:
+		info.primary = read_sources(info.table,info.table.names,0,primary_cat,[primary_freq],scaled_source_nums[0])
+		info.match = read_sources(info.table,info.table.names,12,cat,matched_freqs[matched_cats.index(cat)].split('~'),scaled_source_nums[-1])
+	del columns
+	match_infos.append(info)
+
+##Join every row that isn't a repeated source on to a group for its primary source,
+##using the primary names, so there is no searching through lists of names. All the
+##groups are then held in one source_arrays, group by group, with group_offsets the
+##source each group starts at
+if not stream:
+	group_sources,group_offsets = make_groups([(match_info.primary,match_info.match) for match_info in match_infos],
+		[match_info.table[match_info.table.names[0]] for match_info in match_infos],skip_rows)
+	for info in match_infos:
+		info.primary,info.match = None,None
+	num_groups = len(group_offsets) - 1
+
+##With --stream, merges the tables on primary name with cbl.merge_batch, and yields the
+##sources and group offsets of up to batch_size groups at a time, in order of primary name.
+##Each table is read for just the rows in the batch
+def stream_batches():
+	positions = [0]*len(match_infos)
+	while True:
+		batch_names,counts = cbl.merge_batch([match_info.keys for match_info in match_infos],positions,batch_size)
+		if len(batch_names)==0: return
+		infos,primary_names = [],[]
+		for ind,info in enumerate(match_infos):
+			start,end = positions[ind],positions[ind]+counts[ind]
+			if info.order is None:
+				rows = info.table[start:end]
 			else:
-				src.fluxs.append(str(row[17]))
-				if -100000.0<float(row[18])<=0.0:
-					src.ferrs.append(str(cat_ferr_avg))
-				else:
-					src.ferrs.append(str(row[18]))
-				src.freqs.append(str(cat_freq))
-				
-			
-##Add errors in quadrature
-def error(o1,o2):
-	o1 = o1*dr
-	o2 = o2*dr
-	return o1**2+o2**2
+				rows = info.table[info.order[start:end]]
+			infos.append((read_sources(rows,info.table.names,0,primary_cat,[primary_freq],scaled_source_nums[0],info.primary_means),
+				read_sources(rows,info.table.names,12,info.cat,all_freqs[ind+1],scaled_source_nums[ind+1],info.match_means)))
+			primary_names.append(info.keys[start:end])
+			positions[ind] = end
+		yield make_groups(infos,primary_names,[np.zeros(len(names),dtype=bool) for names in primary_names],by_name=True)
 
-##Create possible premutations of sources in a group
-def do_match(matches,comp):
-	new_match = []
-	for obj in matches:
-		for source in comp:
-			match = [x for x in obj]
-			match.append(source)
-			new_match.append(match)
-	return new_match
+##Returns how many sources of each catalogue (columns) are in each group (rows), for
+##the groups in sources that start at offsets
+def count_cats(sources,offsets):
+	groups = np.repeat(np.arange(len(offsets)-1),np.diff(offsets))
+	counts = np.bincount(groups*len(all_cats) + sources.cat,minlength=(len(offsets)-1)*len(all_cats))
+	return groups,counts.reshape(len(offsets)-1,len(all_cats))
 
-##Calculates angular distance between two celestial points - input degrees, output radians
-def calc_dist(RA1,RA2,Dec1,Dec2):   
-	in1 = (90.0 - Dec1)*dr
-	in2 = (90.0 - Dec2)*dr
-	RA_d = (RA1 - RA2)*dr
-	cosalpha = np.cos(in1)*np.cos(in2) + np.sin(in1)*np.sin(in2)*np.cos(RA_d)
-	##Sometimes get floating point errors if two sources at exactly
-	##the same position, so account for this:
-	if cosalpha>1.0: cosalpha = 1.0
-	elif cosalpha<-1.0: cosalpha = -1.0
-	alpha = np.arccos(cosalpha)
-	return alpha
+##Scores every combination of sources in a batch of groups with cbl.enumerate_combinations.
+##sources holds every source of the batch, and offsets the source each group starts at.
+##The sources are ordered by group and then catalogue (keeping their order in the group)
+##to be enumerated. Returns how many sources of each catalogue each group has, the row in
+##its group of the source chosen from each catalogue for every combination, the offset each
+##group starts at in the combinations, the priors, bayes factors and posteriors, and whether
+##each group was truncated
+def score_batch(sources,offsets):
+	groups,counts = count_cats(sources,offsets)
+	order = np.argsort(groups*len(all_cats) + sources.cat,kind='mergesort')
+	starts = (np.cumsum(counts) - counts.ravel()).reshape(counts.shape)
+	chosen,comb_groups,priors,bayes_factors,posteriors,truncated = cbl.enumerate_combinations(sources.ra[order],sources.dec[order],
+		sources.rerr[order],sources.derr[order],sources.nu[order],starts,counts,floor=posterior_floor,max_combinations=max_combinations)
+	comb_offsets = np.searchsorted(comb_groups,np.arange(len(offsets)))
+	##Every combination points at the row of each of its sources in its group
+	rows = order - offsets[groups[order]]
+	chosen_rows = np.where(chosen>=0,rows[chosen],-1)
+	return counts,chosen_rows,comb_offsets,priors,bayes_factors,posteriors,truncated
 
-def do_bayesian(sources):
-	##Calculate the weight of each source based on astrometric precision
-	#for source in sources: print source.rerr,source.derr 
-	weights = [1/error(source.rerr,source.derr) for source in sources]
-	
-	##Calculate the bayes factor
-	n = len(weights)
-	sum1 = sum(weights)
-	prod1 = 1
-	for i in weights: prod1*=i
-	sum2=0
-	for i in range(0,n+1):
-		for j in range(i+1,n):
-			##Calculate the distance between the two sources
-			distance = calc_dist(sources[i].ra,sources[j].ra,sources[i].dec,sources[j].dec)
-			##Calcualte the second sum
-			sum2+=(weights[i]*weights[j]*distance**2)
-			
-	bayes_factor = (2**(n-1))*(prod1/sum1)*np.exp(-(sum2/(2*sum1)))
-	
-	##Work out which catalogues are present in this combination
-	comps_names = [src.cat for src in sources]
-	inds = [all_cats.index(name) for name in comps_names]
-	
-	##Find out the scaled number of sources for the catalogues present
-	source_nums = [scaled_source_nums[i] for i in inds]
-	
-	#Calcualte prior
-	prod_nums = 1
-	for i in source_nums: prod_nums *= i
-	prior = (source_nums[0]/prod_nums)
+if store:
+	writer = gsl.group_writer(out_name,all_cats,all_freqs)
+else:
+	out_file = open(out_name,'w+')
+
+##With --cache, the cache from the last run is read before any workers are started, so
+##they all share it, and the new cache is written alongside until the run is done
+if cache_name:
+	cache = gsl.score_cache(cache_name,all_cats)
+	cache_writer = gsl.group_writer(cache_name,all_cats,all_freqs,kind='score_cache')
+
+##Returns a key for each group in sources (starting at offsets), from everything its scores
+##depend on - the settings that choose which combinations are kept, and the catalogue, name,
+##position, errors and scaled source density of every source in it, in order, along with
+##where its catalogue comes in the order the catalogues of the group are combined. The
+##catalogue and source names go in as their own characters, each ended by a null, and the
+##numbers as fixed size little-endian records, so a key never depends on how wide a string
+##array happens to be (which changes with the batch, or the catalogues matched)
+def group_keys(sources,offsets):
+	groups,counts = count_cats(sources,offsets)
+	ranks = np.cumsum(counts>0,axis=1) - 1
+	records = np.zeros(len(sources.cat),dtype=[('rank','<i2'),('values','<f8',5)])
+	records['rank'] = ranks[groups,sources.cat]
+	records['values'] = np.column_stack((sources.ra,sources.rerr,sources.dec,sources.derr,sources.nu))
+	cats = [cat + '\0' for cat in all_cats]
+	names = [name + '\0' for name in sources.name.tolist()]
+	cat_nums = sources.cat.tolist()
+	settings = '%r %r\0' %(posterior_floor,max_combinations)
+	keys = []
+	for group in xrange(len(offsets)-1):
+		start,end = offsets[group],offsets[group+1]
+		text = ''.join([cats[cat] for cat in cat_nums[start:end]] + names[start:end])
+		keys.append(hashlib.sha1(settings + text + records[start:end].tostring()).hexdigest())
+	return keys
+
+##A class to store what processing some groups gives: the output for each batch of
+##them (and its score cache columns with --cache), any group with too many combinations
+##(along with how many it could have had), how many combinations there could have been
+##and were written, and how many groups had their scores from the cache, saving how long
+class group_results:
+	def __init__(self):
+		self.outputs = []
+		self.cache_outputs = []
+		self.truncated_groups = []
+		self.num_groups = 0
+		self.num_possible = 0
+		self.num_written = 0
+		self.num_hits = 0
+		self.time_saved = 0.0
+
+##Adds results on to totals, both group_results
+def add_results(totals,results):
+	totals.outputs += results.outputs
+	totals.cache_outputs += results.cache_outputs
+	totals.truncated_groups += results.truncated_groups
+	totals.num_groups += results.num_groups
+	totals.num_possible += results.num_possible
+	totals.num_written += results.num_written
+	totals.num_hits += results.num_hits
+	totals.time_saved += results.time_saved
+
+##MAIN LOOP OF THE COOOOOOOODE!!!
+##Scores and writes out a batch of groups, given as its sources and the offset each group
+##starts at. Every possible combination of the catalogues in a batch is made and scored in
+##one go, and then each group is written out in order. With --cache, only the groups that
+##aren't in the cache are scored, and the rest have their scores from it, so the output is
+##the same either way. Returns a group_results
+def process_batch(batch):
+	sources,offsets = batch
+	results = group_results()
+	num_groups = len(offsets) - 1
+	groups,counts = count_cats(sources,offsets)
+	possible = np.prod(np.maximum(counts,1),axis=1)
+	if cache_name:
+		keys = group_keys(sources,offsets)
+		found = cache.find(keys)
+	else:
+		found = np.zeros(num_groups,dtype=int) - 1
+	missed = np.flatnonzero(found<0)
+	hits = np.flatnonzero(found>=0)
 	
-	##Calculate posterior
-	#posterior = (bayes_factor*prior)/(1+(bayes_factor*prior))   ##The approximation to the posterior in the lims of small priors - 
-	##uncomment if you want to get rid of divide by zero messages (possibly less accurate though)
-	posterior = (1 + ((1 - prior)/(bayes_factor*prior)))**-1
+	##Every combination of the groups that are scored and from the cache, with the
+	##group each is from. The time taken to score is shared out over the groups by how
+	##many combinations each could have had
+	comb_groups,combinations = [],[]
+	truncated = np.zeros(num_groups,dtype=bool)
+	seconds = np.zeros(num_groups)
+	if len(missed)>0:
+		start_time = time.time()
+		sizes = np.diff(offsets)[missed]
+		missed_offsets = np.concatenate(([0],np.cumsum(sizes)))
+		inds = np.repeat(offsets[missed] - missed_offsets[:-1],sizes) + np.arange(missed_offsets[-1])
+		missed_counts,chosen_rows,comb_offsets,priors,bayes_factors,posteriors,truncated[missed] = score_batch(take_sources(sources,inds),missed_offsets)
+		seconds[missed] = (time.time() - start_time)*possible[missed]/float(possible[missed].sum())
+		comb_groups.append(np.repeat(missed,np.diff(comb_offsets)))
+		combinations.append((chosen_rows,bayes_factors,priors,posteriors))
+	if len(hits)>0:
+		hit_counts,hit_combinations,truncated[hits],seconds[hits] = cache.scores(found[hits])
+		comb_groups.append(np.repeat(hits,hit_counts))
+		combinations.append(hit_combinations)
+		results.num_hits = len(hits)
+		results.time_saved = seconds[hits].sum()
+	comb_groups = np.concatenate(comb_groups)
+	order = np.argsort(comb_groups,kind='mergesort')
+	chosen_rows,bayes_factors,priors,posteriors = [np.concatenate(values)[order] for values in zip(*combinations)]
+	written = np.bincount(comb_groups,minlength=num_groups)
 	
-	return prior, bayes_factor, posterior
+	results.truncated_groups = [(sources.name[offsets[group]],possible[group],written[group]) for group in np.flatnonzero(truncated)]
+	results.num_groups = num_groups
+	results.num_possible = possible.sum()
+	results.num_written = written.sum()
+	if cache_name:
+		results.cache_outputs.append(gsl.cache_columns(keys,written,truncated,seconds,(chosen_rows,bayes_factors,priors,posteriors)))
 	
-out_file = open(out_name,'w+')
+	##The store columns are named as the fields of a source_arrays
+	columns = gsl.array_columns(np.diff(offsets),vars(sources),(chosen_rows,bayes_factors,priors,posteriors))
+	gsl.set_group_combinations(columns,written)
+	##For text, write all information for each group and each combination in it here,
+	##so with --workers that is done in the pool too
+	if store:
+		results.outputs.append(columns)
+	else:
+		results.outputs.append(gsl.groups_text(columns,all_cats,all_freqs))
+	return results
 
-##Make a list of all catalogues (we needed the primary catalogue name in a separate list
-##when reading in data, now we need all names in one list in the order the appear in the
-##matched vot tables
-all_cats = matched_cats
-all_cats.insert(0,primary_cat)
+##Does process_batch for every batch of the groups from start to end
+def process_groups(span):
+	start,end = span
+	totals = group_results()
+	for batch_start in xrange(start,end,batch_size):
+		batch_end = min(batch_start+batch_size,end)
+		sources = take_sources(group_sources,slice(group_offsets[batch_start],group_offsets[batch_end]))
+		offsets = group_offsets[batch_start:batch_end+1] - group_offsets[batch_start]
+		add_results(totals,process_batch((sources,offsets)))
+	return totals
 
-##MAIN LOOP OF THE COOOOOOOODE!!!
-for src in source_matches:
-	##Write all information for each source in an indivudual line for each group
-	##Account for catalogues with more than one frequency
-	out_file.write('START_GROUP\n')
-	for i in xrange(len(src.names)):
-		if type(src.freqs[i])!=list:
-			source_string = "%s %s %s %s %s %s %s %s %s %s %s %s %s %s\n" %(src.cats[i],src.names[i],src.ras[i],src.rerrs[i],
-			src.decs[i],src.derrs[i],src.freqs[i],src.fluxs[i],src.ferrs[i],src.majors[i],src.minors[i],src.PAs[i],src.flags[i],src.IDs[i])
-			out_file.write(source_string)
+##With --stream, does process_batch for each batch from stream_batches as it comes, with
+##map_batches (map, or pool.map for --workers) over workers batches at a time, so only
+##that many batches are ever held
+def stream_groups(map_batches):
+	batches = []
+	for batch in stream_batches():
+		batches.append(batch)
+		if len(batches)==workers:
+			for result in map_batches(process_batch,batches): yield result
+			batches = []
+	for result in map_batches(process_batch,batches): yield result
+
+##Groups are independent, so with --workers they are split into runs of consecutive groups,
+##balanced by how many combinations each group could have, and the runs done in a pool of
+##processes. The text for each run is written as soon as it and every run before it are
+##done, so the output is identical to doing them all in order
+if stream:
+	if workers>1:
+		pool = Pool(workers)
+		results = stream_groups(pool.map)
+	else:
+		results = stream_groups(map)
+elif workers>1:
+	groups,counts = count_cats(group_sources,group_offsets)
+	estimates = np.minimum(np.prod(np.maximum(counts,1),axis=1),max_combinations)
+	spans = cbl.balance_chunks(estimates,workers*chunks_per_worker)
+	pool = Pool(workers)
+	results = pool.imap(process_groups,spans)
+else:
+	spans = [(start,min(start+batch_size,num_groups)) for start in xrange(0,num_groups,batch_size)]
+	results = (process_groups(span) for span in spans)
+
+##Each output is written as it comes, and then dropped from the totals
+totals = group_results()
+for span_results in results:
+	for output in span_results.outputs:
+		if store:
+			writer.add_groups(output)
 		else:
-			flux_str=''
-			for j in xrange(len(src.freqs[i])): flux_str+= "%s %s %s " %(src.freqs[i][j],src.fluxs[i][j],src.ferrs[i][j])
-			source_string = "%s %s %s %s %s %s %s%s %s %s %s %s\n" %(src.cats[i],src.names[i],src.ras[i],src.rerrs[i],
-			src.decs[i],src.derrs[i],flux_str,src.majors[i],src.minors[i],src.PAs[i],src.flags[i],src.IDs[i])
-			out_file.write(source_string)
-	
-	##Separate the grouped information in to source_single classes and append to cats
-	##in a specific order
-	cats = [[] for i in all_cats]
-	for i in xrange(len(src.names)):
-		sing_src = source_single()
-		sing_src.cat = src.cats[i]
-		sing_src.name = src.names[i]
-		sing_src.ra = float(src.ras[i])
-		sing_src.rerr = float(src.rerrs[i])
-		sing_src.dec = float(src.decs[i])
-		sing_src.derr = float(src.derrs[i])
-		sing_src.fluxs = src.fluxs[i]
-		sing_src.ferrs = src.ferrs[i]
-		sing_src.major = src.majors[i]
-		sing_src.minor = src.minors[i]
-		sing_src.PA = src.PAs[i]
-		sing_src.flag = src.flags[i]
-		sing_src.ID = src.IDs[i]
-		sing_src.freqs = src.freqs[i]
+			out_file.write(output)
+	for output in span_results.cache_outputs:
+		cache_writer.add_groups(output)
+	span_results.outputs,span_results.cache_outputs = [],[]
+	add_results(totals,span_results)
+if workers>1:
+	pool.close()
+	pool.join()
+if store:
+	writer.finish()
+else:
+	out_file.close()
+if cache_name:
+	cache_writer.finish()
 
-		ind_name = all_cats.index(src.cats[i])
-		cats[ind_name].append(sing_src)
-	
-	##In the next 5 lines, all possible combinations of the catalogues are created
-	matches = [cats[0]]
-	del cats[0]
-	comps = [cat for cat in cats if len(cat)>0]
-	for i in range(0,len(comps)):
-		matches = do_match(matches,comps[i])
-		
-	out_file.write('START_COMP\n')
-	##For each combination of sources, calculate a bayesian factor, a prior and a posterior probability
-	##Write all source information for that match along with prior, bayes_factor and posterior to a single line
-	##If a catalogue hasn't been matched, create a string of -100000.0. This is neccessary for create_table.py
-	##and plot_image.py to be able to automatically pick out the correct information.
-	for option in matches:
-		catss = [source.cat for source in option]
-		prior,bayes,posterior =  do_bayesian(option)
-		match_str=''
-		for cat in all_cats:
-			if cat in catss:
-				src = option[catss.index(cat)]
-				if type(src.freqs)!=list:
-					match_str += "%s %s %s %s %s %s %s %s %s %s %s %s %s %s " %(src.cat,src.name,str(src.ra),str(src.rerr),
-					str(src.dec),str(src.derr),src.freqs,src.fluxs,src.ferrs,src.major,src.minor,src.PA,src.flag,src.ID)
-				else:
-					flux_str=''
-					for j in xrange(len(src.freqs)): flux_str+= "%s %s %s " %(src.freqs[j],src.fluxs[j],src.ferrs[j])
-					match_str += "%s %s %s %s %s %s %s%s %s %s %s %s " %(src.cat,src.name,str(src.ra),str(src.rerr),
-					str(src.dec),str(src.derr),flux_str,src.major,src.minor,src.PA,src.flag,src.ID)
-			else:
-				if num_freqs[all_cats.index(cat)]==1:
-					match_str += "-100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 "
-				else:
-					extra_str = ""
-					for j in xrange(num_freqs[all_cats.index(cat)]-1): extra_str+= "-100000.0 -100000.0 -100000.0 "
-					match_str += "-100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 -100000.0 " \
-					"-100000.0 -100000.0 -100000.0 -100000.0 %s" %extra_str
-		match_str += '%s %s %s\n' %(str(bayes),str(prior),str(posterior))
-		out_file.write(match_str)
-	out_file.write('END_COMP\n')
-	out_file.write('END_GROUP\n')
-out_file.close()
\ No newline at end of file
+truncated_groups = totals.truncated_groups
+num_possible = totals.num_possible
+num_written = totals.num_written
+if cache_name:
+	print 'Reused the scores of %d of %d groups (%.1f%%) from %s, saving about %.2fs of scoring' %(totals.num_hits,totals.num_groups,
+		100.0*totals.num_hits/max(totals.num_groups,1),cache_name,totals.time_saved)
+if posterior_floor>0.0:
+	print 'Wrote %d of %d combinations with a posterior of at least %s' %(num_written,num_possible,posterior_floor)
+if len(truncated_groups)>0:
+	truncated_name = '%s_truncated.txt' %os.path.splitext(out_name)[0]
+	truncated_file = open(truncated_name,'w+')
+	truncated_file.write('#primary_name combinations_possible combinations_written\n')
+	for name,possible,written in truncated_groups:
+		truncated_file.write('%s %d %d\n' %(name,possible,written))
+	truncated_file.close()
+	print '%d groups had more than %d combinations and were truncated - see %s' %(len(truncated_groups),max_combinations,truncated_name)
+print tal.bytes_report()
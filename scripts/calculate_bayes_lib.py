@@ -0,0 +1,298 @@
+#!/usr/bin/python
+import numpy as np
+
+dr = np.pi/180.0
+
+def find_repeats(match_names,separations):
+	'''Finds the matched sources that were matched to more than one primary source.
+	For each, only the row with the smallest separation is kept (the first of those
+	if tied). Everything is done with one sort on name, separation and row.
+	Returns a boolean array that is True for every row to skip, and the number
+	of sources matched more than once'''
+	match_names = np.asarray(match_names)
+	separations = np.asarray(separations,dtype=float)
+	rows = np.arange(len(match_names))
+	order = np.lexsort((rows,separations,match_names))
+	sorted_names = match_names[order]
+	##The first row of each name in the sorted order is the one to keep
+	first = np.ones(len(sorted_names),dtype=bool)
+	first[1:] = sorted_names[1:]!=sorted_names[:-1]
+	skip = np.zeros(len(match_names),dtype=bool)
+	skip[order] = ~first
+	num_repeated = np.count_nonzero(first[:-1] & ~first[1:])
+	return skip,num_repeated
+
+def assemble_groups(primary_names,skips,by_name=False):
+	'''Joins the rows of every matched table on to groups, one group per primary source.
+	primary_names holds an array of the primary name of every row for each matched table,
+	and skips the boolean arrays of rows to skip. Groups are numbered in the order they
+	first appear, reading the tables in order, or by primary name with by_name=True. Returns the table number and row of every
+	source in every group, whether each is the primary source, and the offset that each
+	group starts at in those arrays. Each group starts with the primary source (from the
+	row it first appears in) and then has every matched source, in table then row order'''
+	tables = np.concatenate([np.zeros(len(names),dtype=int) + ind for ind,names in enumerate(primary_names)])
+	rows = np.concatenate([np.arange(len(names)) for names in primary_names])
+	names = np.concatenate([np.asarray(names) for names in primary_names])
+	keep = ~np.concatenate(skips)
+	tables,rows,names = tables[keep],rows[keep],names[keep]
+
+	##np.unique numbers the groups by name, so renumber them by first appearance
+	unique_names,first,inverse = np.unique(names,return_index=True,return_inverse=True)
+	if by_name:
+		order = np.arange(len(first))
+	else:
+		order = np.argsort(first)
+	renumber = np.empty(len(order),dtype=int)
+	renumber[order] = np.arange(len(order))
+	group_ids = renumber[inverse]
+	num_matches = np.bincount(group_ids,minlength=len(order))
+	offsets = np.concatenate(([0],np.cumsum(num_matches + 1)))
+
+	group_tables = np.empty(offsets[-1],dtype=int)
+	group_rows = np.empty(offsets[-1],dtype=int)
+	is_primary = np.zeros(offsets[-1],dtype=bool)
+	starts = offsets[:-1]
+	group_tables[starts] = tables[first[order]]
+	group_rows[starts] = rows[first[order]]
+	is_primary[starts] = True
+
+	##A stable sort on group keeps the table then row order within each group
+	sort = np.argsort(group_ids,kind='mergesort')
+	sorted_ids = group_ids[sort]
+	match_starts = np.concatenate(([0],np.cumsum(num_matches)))[:-1]
+	places = starts[sorted_ids] + 1 + np.arange(len(sort)) - match_starts[sorted_ids]
+	group_tables[places] = tables[sort]
+	group_rows[places] = rows[sort]
+	return group_tables,group_rows,is_primary,offsets
+
+def merge_batch(keys,positions,batch_size):
+	'''One step of a k-way merge. keys holds a sorted array of keys for each table, and
+	positions how far through each the merge has got. Returns the next batch_size (or
+	fewer at the end) distinct keys of all the tables, in order, and how many entries of
+	each table have those keys. Only a window of each table past its position is looked
+	at; any key below the last key of every window that doesn't reach the end of its
+	table must be wholly inside the windows. The windows are widened if one key fills them'''
+	window = batch_size
+	while True:
+		windows = [table_keys[pos:pos+window] for table_keys,pos in zip(keys,positions)]
+		limits = [win[-1] for table_keys,pos,win in zip(keys,positions,windows) if pos+window<len(table_keys)]
+		candidates = np.unique(np.concatenate(windows))
+		if len(limits)==0: break
+		candidates = candidates[candidates<min(limits)]
+		if len(candidates)>0: break
+		window *= 2
+	batch = candidates[:batch_size]
+	if len(batch)==0: return batch,[0]*len(keys)
+	return batch,[int(np.searchsorted(win,batch[-1],side='right')) for win in windows]
+
+def column_strings(column):
+	'''Returns every value in a column as the string str() gives for it'''
+	return np.array([str(value) for value in column],dtype=str)
+
+def text_values(column):
+	'''Returns a column as floats, each being the float of the string str() gives for the value.
+	Those are the values written out and scored, so a column of 4 byte floats is read through
+	its strings, and any other column is just copied'''
+	values = np.asarray(column)
+	if values.dtype.kind in 'iu' or (values.dtype.kind=='f' and values.dtype.itemsize==8):
+		return values.astype(float)
+	return np.array(column_strings(column),dtype=float)
+
+def proxy_errors(errors,proxy,flux=False):
+	'''Returns a column of errors as floats (see text_values), with any zero or negative error
+	swapped for proxy. For flux errors (flux=True), -100000.0 and below mean there is no
+	error, so those are left alone'''
+	values = text_values(errors)
+	bad = values<=0.0
+	if flux: bad &= values>-100000.0
+	return np.where(bad,float(str(proxy)),values)
+
+def null_flags(column):
+	'''Returns a column of flags or IDs as strings, with any empty ('' or '--') entry
+	set to the null value of -100000.0'''
+	strings = column_strings(column)
+	return np.where((strings=='') | (strings=='--'),'-100000.0',strings)
+
+def source_weights(rerrs,derrs):
+	'''Weight of each source from its astrometric precision, with the errors (in degrees)
+	added in quadrature'''
+	return 1.0/((rerrs*dr)**2 + (derrs*dr)**2)
+
+def angular_distance(RA1,RA2,Dec1,Dec2):
+	'''Calculates angular distance between two celestial points - input degrees, output radians'''
+	in1 = (90.0 - Dec1)*dr
+	in2 = (90.0 - Dec2)*dr
+	RA_d = (RA1 - RA2)*dr
+	cosalpha = np.cos(in1)*np.cos(in2) + np.sin(in1)*np.sin(in2)*np.cos(RA_d)
+	##Sometimes get floating point errors if two sources at exactly
+	##the same position, so account for this
+	return np.arccos(np.clip(cosalpha,-1.0,1.0))
+
+def bayes_posteriors(num_sources,sum1,log_prod1,sum2,log_prior):
+	'''Turns the sums over the sources of many combinations into their priors, bayes
+	factors and posteriors. sum1 is the sum of the weights, log_prod1 the log of their
+	product, sum2 the sum of w_i*w_j*d_ij**2 over every pair, and log_prior the log of
+	the prior. The bayes factor is worked out in log space, so it never underflows part
+	way through a combination with many sources'''
+	log_bayes = (num_sources - 1)*np.log(2.0) + log_prod1 - np.log(sum1) - sum2/(2*sum1)
+	bayes_factors = np.exp(log_bayes)
+	priors = np.exp(log_prior)
+	##(bayes_factor*prior) can be too small to hold even when the log isn't, in which
+	##case the posterior is zero, as before
+	with np.errstate(over='ignore'):
+		posteriors = 1.0/(1.0 + (1.0 - priors)*np.exp(-(log_bayes + log_prior)))
+	return priors,bayes_factors,posteriors
+
+def segment_extremes(values,segments,num_segments):
+	'''Returns the minimum and maximum of values in each segment (numbered 0 to
+	num_segments-1). Empty segments get +inf and -inf'''
+	mins = np.full(num_segments,np.inf)
+	maxs = np.full(num_segments,-np.inf)
+	np.minimum.at(mins,segments,values)
+	np.maximum.at(maxs,segments,values)
+	return mins,maxs
+
+def remaining_sums(values,present):
+	'''For a 2D array of values per group and catalogue, returns the sum over every later
+	catalogue that is present in the group, e.g. [:,2] is the sum of [:,3:]'''
+	values = np.where(present,values,0.0)
+	totals = np.cumsum(values[:,::-1],axis=1)[:,::-1]
+	return np.concatenate((totals[:,1:],np.zeros((len(values),1))),axis=1)
+
+##The most partial combinations enumerate_combinations makes at once. Adding a catalogue
+##to more than this is done a run of partial combinations at a time
+max_expansion = 1000000
+
+def enumerate_combinations(ras,decs,rerrs,derrs,nus,cat_starts,cat_counts,floor=0.0,max_combinations=None):
+	'''Makes and scores every combination of sources in many groups at once, where each
+	combination has one source from every catalogue present in its group. The sources of
+	every group are given as flat arrays, ordered by group and then catalogue, with the
+	primary catalogue first. cat_starts and cat_counts (shape groups x catalogues) give the
+	index of the first source and number of sources of each catalogue in each group.
+	
+	The combinations are built up a catalogue at a time, in the same order as looping over
+	every catalogue in turn; each partial combination carries the sums of its weights, log
+	weights, log densities and w_i*w_j*d_ij**2 pair terms, so adding a source only adds its
+	pair terms with the sources already chosen. No more than max_expansion partial
+	combinations are made at once.
+	
+	If floor is above zero, any partial combination where even the best choice of sources
+	still to come can't reach a posterior of floor is dropped, along with every combination
+	that would have been made from it. If max_combinations is given, no group keeps more than
+	that many (partial) combinations at any step - the first ones made are kept, and the
+	group is marked as truncated. With no floor, the ones past max_combinations are never made.
+	
+	Returns the source chosen from every catalogue for each combination (-1 for catalogues
+	not in the group), the group of each combination, the priors, bayes factors and
+	posteriors, and whether each group was truncated'''
+	num_groups,num_cats = cat_counts.shape
+	weights = source_weights(rerrs,derrs)
+	log_weights = np.log(weights)
+	log_nus = np.log(nus)
+	
+	##The best any catalogue still to come can do for a combination. Adding a source
+	##adds log(2*w/nu) to log(bayes_factor*prior), and the sum of the weights ends up
+	##between adding the smallest and largest weight of every catalogue still to come
+	if floor>0.0:
+		present = cat_counts>0
+		segments = np.repeat(np.arange(num_groups*num_cats),cat_counts.ravel())
+		min_w,max_w = segment_extremes(weights,segments,num_groups*num_cats)
+		max_gain = segment_extremes(log_weights - log_nus,segments,num_groups*num_cats)[1]
+		max_log_nu = segment_extremes(-log_nus,segments,num_groups*num_cats)[1]
+		rem_gain = remaining_sums(max_gain.reshape(cat_counts.shape) + np.log(2.0),present)
+		rem_min_w = remaining_sums(min_w.reshape(cat_counts.shape),present)
+		rem_max_w = remaining_sums(max_w.reshape(cat_counts.shape),present)
+		rem_prior = remaining_sums(max_log_nu.reshape(cat_counts.shape),present)
+	
+	##Drops any partial combination that can't reach floor, and any over max_combinations
+	##in a group, having just added catalogue cat. kept is how many each group already
+	##has from earlier runs, and is added to
+	truncated = np.zeros(num_groups,dtype=bool)
+	def prune(state,cat,kept):
+		groups,chosen,num_sources,sum1,log_prod1,sum2,log_prior = state
+		keep = np.ones(len(groups),dtype=bool)
+		if floor>0.0:
+			best_log = (num_sources - 1)*np.log(2.0) + log_prod1 + log_prior + rem_gain[groups,cat] \
+				- np.log(sum1 + rem_min_w[groups,cat]) - sum2/(2*(sum1 + rem_max_w[groups,cat]))
+			best_prior = np.exp(log_prior + rem_prior[groups,cat])
+			##With a prior of 1 or more, the posterior can be anything up to 1
+			with np.errstate(over='ignore'):
+				best_posterior = np.where(best_prior<1.0,1.0/(1.0 + (1.0 - best_prior)*np.exp(-best_log)),1.0)
+			keep &= best_posterior>=floor
+		if max_combinations is not None:
+			##Groups are in order, so the rank of each combination in its group comes from
+			##where each group starts
+			kept_groups = groups[keep]
+			ranks = np.arange(len(kept_groups)) - np.searchsorted(kept_groups,kept_groups) + kept[kept_groups]
+			over = ranks>=max_combinations
+			truncated[np.unique(kept_groups[over])] = True
+			keep[np.flatnonzero(keep)[over]] = False
+		kept += np.bincount(groups[keep],minlength=num_groups)
+		return [values[keep] for values in state]
+	
+	##Start with the primary source of each group
+	groups = np.arange(num_groups)
+	chosen = np.full((num_groups,num_cats),-1,dtype=int)
+	chosen[:,0] = cat_starts[:,0]
+	state = [groups,chosen,np.ones(num_groups,dtype=int),weights[chosen[:,0]],
+		log_weights[chosen[:,0]],np.zeros(num_groups),np.zeros(num_groups)]
+	state = prune(state,0,np.zeros(num_groups,dtype=int))
+	
+	for cat in xrange(1,num_cats):
+		##Each partial combination is repeated once for every source of this catalogue in
+		##its group, or kept as it is if there are none. This is done for a run of partial
+		##combinations at a time, so no more than max_expansion are made at once
+		counts = cat_counts[state[0],cat]
+		repeats = np.maximum(counts,1)
+		made = np.cumsum(repeats)
+		kept = np.zeros(num_groups,dtype=int)
+		runs = []
+		start = 0
+		while start<len(counts):
+			end = max(start + 1,np.searchsorted(made,made[start] - repeats[start] + max_expansion,side='right'))
+			run_groups = state[0][start:end]
+			run_repeats = repeats[start:end]
+			if max_combinations is not None and floor<=0.0:
+				##With no floor every combination made is kept until its group is full,
+				##so only make as many as there is room for
+				before = np.cumsum(run_repeats) - run_repeats
+				before = before - before[np.searchsorted(run_groups,run_groups)] + kept[run_groups]
+				room = np.clip(max_combinations - before,0,run_repeats)
+				truncated[run_groups[room<run_repeats]] = True
+				run_repeats = room
+			parents = np.repeat(np.arange(start,end),run_repeats)
+			groups,chosen,num_sources,sum1,log_prod1,sum2,log_prior = [values[parents] for values in state]
+			
+			adding = np.repeat(counts[start:end]>0,run_repeats)
+			positions = np.arange(len(parents)) - (np.cumsum(run_repeats) - run_repeats)[parents - start]
+			new = (cat_starts[groups,cat] + positions)[adding]
+			chosen[adding,cat] = new
+			num_sources[adding] += 1
+			sum1[adding] += weights[new]
+			log_prod1[adding] += log_weights[new]
+			log_prior[adding] -= log_nus[new]
+			
+			##Only the pair terms between the new source and those already chosen are needed
+			add_rows = np.flatnonzero(adding)
+			for prev in xrange(cat):
+				prev_inds = chosen[add_rows,prev]
+				has_prev = prev_inds>=0
+				inds1,inds2 = prev_inds[has_prev],new[has_prev]
+				sum2[add_rows[has_prev]] += weights[inds1]*weights[inds2]*angular_distance(ras[inds1],ras[inds2],decs[inds1],decs[inds2])**2
+			runs.append(prune([groups,chosen,num_sources,sum1,log_prod1,sum2,log_prior],cat,kept))
+			start = end
+		if len(runs)>0:
+			state = [np.concatenate([run[i] for run in runs]) for i in xrange(len(state))]
+	
+	groups,chosen,num_sources,sum1,log_prod1,sum2,log_prior = state
+	priors,bayes_factors,posteriors = bayes_posteriors(num_sources,sum1,log_prod1,sum2,log_prior)
+	return chosen,groups,priors,bayes_factors,posteriors,truncated
+
+def balance_chunks(costs,num_chunks):
+	'''Splits a list of costs into up to num_chunks runs of consecutive entries, each with
+	roughly the same total cost. Returns the (start,end) of every run'''
+	if len(costs)==0: return []
+	cumulative = np.cumsum(costs,dtype=float)
+	targets = cumulative[-1]*np.arange(1,num_chunks)/float(num_chunks)
+	edges = np.unique(np.concatenate(([0],np.searchsorted(cumulative,targets,side='right'),[len(costs)])))
+	return [(int(edges[i]),int(edges[i+1])) for i in xrange(len(edges)-1)]
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+
+##Bump this if the layout of a normalised catalogue store ever changes,
+##so old cache entries are never read back in the wrong format
+store_version = '1'
+
+def hash_file(name,block_size=2**20):
+	'''Returns the sha1 hex digest of the contents of a file, reading in blocks
+	so large catalogues don't need to fit in memory'''
+	sha = hashlib.sha1()
+	with open(name,'rb') as infile:
+		block = infile.read(block_size)
+		while block:
+			sha.update(block)
+			block = infile.read(block_size)
+	return sha.hexdigest()
+
+def cache_key(name,*extras):
+	'''Creates a cache key from the contents of a file, plus any strings that
+	change how that file gets normalised (e.g. the --details and --units inputs)'''
+	sha = hashlib.sha1()
+	sha.update(store_version.encode('utf-8'))
+	sha.update(hash_file(name).encode('utf-8'))
+	for extra in extras:
+		sha.update(('|%s' %extra).encode('utf-8'))
+	return sha.hexdigest()
+
+def create_store(store_dir,dtypes,entries):
+	'''Creates empty memory-mapped .npy files, one per column, ready to be filled in
+	a chunk at a time. dtypes is a dictionary of column name to numpy dtype. Everything
+	is written to a temporary directory until finish_store is called. Returns the
+	temporary directory and a dictionary of the writable columns'''
+	temp_dir = '%s.tmp%d' %(store_dir,os.getpid())
+	if os.path.exists(temp_dir): shutil.rmtree(temp_dir)
+	os.makedirs(temp_dir)
+	columns = {}
+	for name,dtype in dtypes.items():
+		columns[name] = np.lib.format.open_memmap(os.path.join(temp_dir,'%s.npy' %name),mode='w+',dtype=dtype,shape=(entries,))
+	return temp_dir,columns
+
+def finish_store(temp_dir,store_dir,columns,meta):
+	'''Flushes the columns made by create_store, writes the meta data and renames the
+	temporary directory to store_dir, so a half written store can never be read back'''
+	for column in columns.values():
+		column.flush()
+	meta = dict(meta)
+	meta['columns'] = sorted(columns.keys())
+	with open(os.path.join(temp_dir,'meta.json'),'w') as outfile:
+		json.dump(meta,outfile)
+	if os.path.exists(store_dir): shutil.rmtree(store_dir)
+	os.rename(temp_dir,store_dir)
+
+def save_store(store_dir,columns,meta):
+	'''Writes a dictionary of column arrays into store_dir as one .npy file
+	per column, along with any meta data'''
+	dtypes = dict([(name,np.asarray(column).dtype) for name,column in columns.items()])
+	entries = len(list(columns.values())[0])
+	temp_dir,store_columns = create_store(store_dir,dtypes,entries)
+	for name,column in columns.items():
+		store_columns[name][:] = column
+	finish_store(temp_dir,store_dir,store_columns,meta)
+
+def load_store(store_dir,mmap_mode='r'):
+	'''Opens a store written by save_store. Columns are memory-mapped, so only the
+	parts that get used are read from disk. Returns None,None if the store doesn't exist'''
+	meta_name = os.path.join(store_dir,'meta.json')
+	if not os.path.exists(meta_name): return None,None
+	with open(meta_name) as infile:
+		meta = json.load(infile)
+	columns = {}
+	for name in meta['columns']:
+		columns[name] = np.load(os.path.join(store_dir,'%s.npy' %name),mmap_mode=mmap_mode)
+	##Mark as recently used for the eviction policy
+	os.utime(meta_name,None)
+	return columns,meta
+
+def update_meta(store_dir,**entries):
+	'''Adds entries to the meta data of an existing store'''
+	meta_name = os.path.join(store_dir,'meta.json')
+	with open(meta_name) as infile:
+		meta = json.load(infile)
+	meta.update(entries)
+	with open(meta_name,'w') as outfile:
+		json.dump(meta,outfile)
+
+def store_size(store_dir):
+	'''Total size in bytes of all files in a store, including anything saved
+	alongside it in sub-directories (e.g. a zone index)'''
+	return sum([os.path.getsize(os.path.join(path,name)) for path,dirs,names in os.walk(store_dir) for name in names])
+
+def evict_cache(cache_dir,max_bytes,keep=[]):
+	'''Deletes the least recently used stores in cache_dir until the total size is
+	below max_bytes. Any store named in keep is never deleted'''
+	if not os.path.isdir(cache_dir): return []
+	stores = []
+	for name in os.listdir(cache_dir):
+		store_dir = os.path.join(cache_dir,name)
+		meta_name = os.path.join(store_dir,'meta.json')
+		if os.path.exists(meta_name):
+			stores.append((os.path.getmtime(meta_name),name,store_size(store_dir)))
+	total = sum([size for used,name,size in stores])
+	evicted = []
+	for used,name,size in sorted(stores):
+		if total<=max_bytes: break
+		if name in keep: continue
+		shutil.rmtree(os.path.join(cache_dir,name))
+		total -= size
+		evicted.append(name)
+	return evicted
@@ -0,0 +1,48 @@
+#!/usr/bin/python
+import optparse
+import sys
+import group_store_lib as gsl
+
+##Converts the output of calculate_bayes.py between the text format and a binary
+##group store, either way round
+parser = optparse.OptionParser()
+
+parser.add_option('-i', '--input',
+	help='Enter name of the calculate_bayes.py output to convert - a text file or a group store')
+
+parser.add_option('-o', '--output',
+	help='Enter name for the converted output - a group store if the input is text, or text if the input is a group store')
+
+parser.add_option('-m', '--matched_cats',
+	help='Text input only - enter names of matched cataloges, in order of match')
+
+parser.add_option('-c', '--cat_freqs',
+	help='Text input only - enter frequencies of each catalogue, separated by commas. If more than one frequency, separate by ~')
+
+parser.add_option('-b', '--batch_size', default=1000, type='int',
+	help='Number of groups to convert at once when writing a group store (default 1000)')
+
+options, args = parser.parse_args()
+
+if gsl.is_store(options.input):
+	store = gsl.group_store(options.input)
+	out_file = open(options.output,'w+')
+	for group in xrange(len(store)):
+		out_file.write(store.group_text(group))
+	out_file.close()
+else:
+	if not options.matched_cats or not options.cat_freqs:
+		sys.exit('To convert text to a group store, enter --matched_cats and --cat_freqs')
+	cats = options.matched_cats.split(',')
+	freqs = [freq.split('~') for freq in options.cat_freqs.split(',')]
+	if len(cats)!=len(freqs):
+		sys.exit('Enter a set of frequencies for every catalogue in --matched_cats')
+	writer = gsl.group_writer(options.output,cats,freqs)
+	batch = []
+	for columns in gsl.read_text_groups(options.input,cats,freqs):
+		batch.append(columns)
+		if len(batch)==options.batch_size:
+			writer.add_groups(gsl.join_columns(batch))
+			batch = []
+	if len(batch)>0: writer.add_groups(gsl.join_columns(batch))
+	writer.finish()
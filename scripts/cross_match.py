@@ -4,8 +4,12 @@ import numpy as np
 import subprocess
 import optparse
 import os
-from astropy.table import Table, Column, MaskedColumn
-from astropy.io.votable import parse as vot_parse
+import sys
+import time
+import cross_match_lib as cml
+import catalogue_store_lib as csl
+import table_access_lib as tal
+from astropy.table import Table, Column
 try:
 	import pyfits as fits
 except ImportError:
@@ -14,36 +18,66 @@ except ImportError:
 parser = optparse.OptionParser()
 
 parser.add_option('-a', '--table1',
-	help='Enter name of table1')
+	help='Enter name of table1. Can be a FITS or VOTable, or a .tar.bz2 archive holding one')
 
-parser.add_option('-b', '--table2',
-	help='Enter name of table2')
+parser.add_option('-b', '--table2',action='append',
+	help='Enter name of table2. To match table1 against more than one catalogue in one go, repeat --table2 (and all the other *2 options) for each catalogue')
 
 parser.add_option('-c', '--details1',
 	help='Enter table1 details name,RA,RA_error,Dec,Dec_error,freq,flux,flux_error,PA,major,minor,flags,ID,freq2,flux2,flux2_error,flux3,flux3_error etc.' \
 	'Any columns that do not exist, input -. Add as many fluxs as required')
 
-parser.add_option('-d', '--details2',
+parser.add_option('-d', '--details2',action='append',
 	help='Enter table2 details')
 
 parser.add_option('-e', '--units1',
 	help='Enter table1 units in order of RA,RA_error,Dec,Dec_error,flux,flux_error,PA,major,minor' \
 	     'Enter as | for angles: either deg,arcsec,arcmin,min,sec | for flux: either Jy,mJy      ')
 
-parser.add_option('-f', '--units2',
+parser.add_option('-f', '--units2',action='append',
 	help='Enter table2 units')
 
 parser.add_option('-g', '--prefix1',
-	help='Enter name of table1')
+	help='Enter name of table1. Can be a FITS or VOTable, or a .tar.bz2 archive holding one')
 
-parser.add_option('-i', '--prefix2',
+parser.add_option('-i', '--prefix2',action='append',
 	help='Enter name of table2')
 
+parser.add_option('-j', '--sigma',default=None,
+	help='Enter --sigma=N to also cut any pair further apart than N times the combined positional error of the two sources. Needs both catalogues to have RA and Dec errors')
+
+parser.add_option('-k', '--cache_dir',default=None,
+	help='Enter a directory to cache the normalised tables in. Any table already in the cache (with the same details and units) is not re-read')
+
+parser.add_option('-l', '--cache_size',default=2000,
+	help='Maximum size of the cache in MB. The least recently used tables are deleted when full (default 2000)')
+
 parser.add_option('-m', '--make_table',action='store_true',default=False,
 	help='Add to store the simple tables')
 
+parser.add_option('-n', '--chunk_size',default=None,
+	help='Add --chunk_size=N to read, normalise, match and write FITS tables N rows at a time, so tables larger than memory can be matched. Needs --cache_dir to be set')
+
+parser.add_option('-o', '--pairs',action='store_true',default=False,
+	help='Add to write the matches as compact pairs_*/ stores (row index into each cached catalogue and the separation) instead of matched_*.fits tables. Needs --cache_dir to be set')
+
+parser.add_option('-p', '--workers',default=1,
+	help='Add --workers=N to split the sky into declination strips and match them in N processes (native matcher only)')
+
+parser.add_option('-q', '--groups',action='store_true',default=False,
+	help='Add to link the matched sources of all catalogues into friends-of-friends groups, writing the group ID and size of every matched source to groups_<prefix1>.fits (native matcher only). The groups are for information only: calculate_bayes.py does not read them, and still settles sources matched to more than one table1 source by separation')
+
+parser.add_option('-r', '--separation2',action='append',
+	help='Enter a matching radius in arcsecs for this table2 only, to override --separation. If used, enter once for every --table2')
+
 parser.add_option('-s', '--separation',
-	help='Enter matching radius in arcsecs')
+	help='Enter matching radius in arcsecs. Can be left out if --separation2 is entered for every --table2')
+
+parser.add_option('-t', '--matcher',default='native',
+	help='Enter --matcher=stilts to cross match using stilts tmatch2 instead of the native sky matcher')
+
+parser.add_option('-u', '--density_cell',default=None,
+	help='Enter a cell size in deg to bin each catalogue on to a sky grid, and use the smoothed local source density around every source as the prior in calculate_bayes.py. The --ra_lims and --dec_lims then become optional')
 
 parser.add_option('-v', '--verbose',action='store_true',default=False,
 	help='Enter to turn on all of the astropy warnings')
@@ -54,10 +88,10 @@ parser.add_option('-w', '--ra_lims1',
 parser.add_option('-x', '--dec_lims1',
 	help='Enter Dec lims to calculate source density of catalogue 1')
 
-parser.add_option('-y', '--ra_lims2',
+parser.add_option('-y', '--ra_lims2',action='append',
 	help='Enter RA lims to calculate source density of catalogue 2')
 
-parser.add_option('-z', '--dec_lims2',
+parser.add_option('-z', '--dec_lims2',action='append',
 	help='Enter Dec lims to calculate source density of catalogue 2')
 
 options, args = parser.parse_args()
@@ -73,231 +107,312 @@ else:
 
 dr = np.pi/180.0
 
-def get_units(data,detail,unit,unit_type,entries):
-	'''A function for either returning an array of -100000.0s of
-	a given length, or taking a given array and performing unit conversion,
-	given the specified units'''
-	if detail=='-':
-		column = np.empty(entries); column.fill(-100000.0)
-	else:
-		if unit_type=='angle':
-			if unit=='deg':
-				column = data[detail]
-			elif unit=='arcmin':
-				column = data[detail]/60.0
-			elif unit=='arcsec':
-				column = data[detail]/3600.0
-			elif unit=='min':
-				column = data[detail]*(15.0/60.0)
-			elif unit=='sec':
-				column = data[detail]*(15.0/3600.0)
-			else:
-				print 'angle coversion error'
-		if unit_type=='flux':
-			if unit=='Jy':
-				column = data[detail]
-			elif unit=='mJy':
-				column = data[detail]/1000.0
-			else:
-				print 'flux conversion error'
-	return column
-
-def get_units_blanks(data,detail,unit,unit_type,entries):
-	'''A function for either returning an array of -100000.0s of
-	a given length, or taking a given array and performing unit conversion,
-	given the specified units. Can handle the input array having a blank
-	input. Slower than get_units'''
-	column = np.empty(entries); column.fill(-100000.0)
-	if detail=='-':
-		return column
-	else:
-		if unit_type=='angle':
-			if unit=='deg':
-				factor = 1.0
-			elif unit=='arcmin':
-				factor = 1.0/60.0
-			elif unit=='arcsec':
-				factor = 1.0/3600.0
-			elif unit=='min':
-				factor = 15.0 / 60.0
-			elif unit=='sec':
-				factor = 15.0 / 3600.0
-			else:
-				print 'angle coversion error'
-		if unit_type=='flux':
-			if unit=='Jy':
-				factor = 1.0
-			elif unit=='mJy':
-				factor = 1.0 / 1000.0
-			else:
-				print 'flux conversion error'
-
-
-		# I am guessing that the -100000.0 is used as a marker
-		# for when an item is empty. I am not 100% certain of
-		# the best way to handle it with the ndarray element
-		# broadcasting (for it to work properly they all need to
-		# be floats). So, try to the speedy way, fall back to the
-		# slow way
-
-		try:
-			print data[detail].dtype
-			column = data[detail] * factor
-		except:
-			for i in xrange(entries):
-				try:
-					entry = float(data[detail][i])
-					column[i] = entry * factor
-				except ValueError:
-					column[i] = -100000.0
-		return column
-
-def make_table(data,details,units,prefix,ra_lims,dec_lims):
-	##Find all of the data in the columns as specified by the
-	##user inputs
-	shape = data.shape
-	entries = shape[0]
-	names = data[details[0]]
-	RA = get_units(data,details[1],units[0],'angle',entries)
-	RA_error = get_units(data,details[2],units[1],'angle',entries)
-	Dec = get_units(data,details[3],units[2],'angle',entries)
-	Dec_error = get_units(data,details[4],units[3],'angle',entries)
-	freq = details[5]
-	flux = get_units_blanks(data,details[6],units[4],'flux',entries)
-	flux_error = get_units_blanks(data,details[7],units[5],'flux',entries)
-	PA = get_units_blanks(data,details[8],units[6],'angle',entries)
-	major = get_units_blanks(data,details[9],units[7],'angle',entries)
-	minor = get_units_blanks(data,details[10],units[8],'angle',entries)
-
-	if details[11]=='-':
-		flags = np.empty(entries); flags.fill(-100000.0)
-	else:
-		flags = data[details[11]]
-	if details[12]=='-':
-		ID = np.empty(entries); ID.fill(-100000.0)
+def get_lune(ra1,ra2,dec1,dec2):
+	'''Calculates the steradian coverage of a lune defined by two RA,Dec
+	coords'''
+	return abs((ra2*dr-ra1*dr)*(np.sin(dec2*dr)-np.sin(dec1*dr)))
+
+def get_source_density(RA,Dec,ra_lims,dec_lims):
+	'''Count the number of sources within the requested user lune to calculate the scaled
+	source density of the catalogues. Counts chunk_size rows at a time if --chunk_size is set.
+	Returns None if no lune was entered'''
+	if ra_lims is None: return None
+	if options.chunk_size:
+		chunks = cml.get_chunks(len(RA),int(options.chunk_size))
 	else:
-		ID = data[details[12]]
-	freqs = []
-	fluxs = []
-	ferrs = []
-	##This handles the case of more than one frequency in a single catalogue
-	if len(details)>13:
-		length = len(details) - 13
-		num_of_freqs = length / 3
-		for i in xrange(num_of_freqs):
-			freqs.append(details[13+(3*i)])
-			fluxs.append(get_units_blanks(data,details[13+1+(3*i)],units[9+(2*i)],'flux',entries))
-			ferrs.append(get_units_blanks(data,details[13+2+(3*i)],units[10+(2*i)],'flux',entries))
-
-	def get_lune(ra1,ra2,dec1,dec2):
-		'''Calculates the steradian coverage of a lune defined by two RA,Dec
-		coords'''
-		return abs((ra2*dr-ra1*dr)*(np.sin(dec2*dr)-np.sin(dec1*dr)))
-
-	##Count the number of sources within the requested user lune to calculate the scaled
-	##source density of the catalogues
+		chunks = [(0,len(RA))]
+	num_in_bounds = sum([cml.count_in_bounds(RA[start:stop],Dec[start:stop],ra_lims,dec_lims) for start,stop in chunks])
 	##If the ra lims do not cross over the RA = 0 line
 	if ra_lims[0]<ra_lims[1]:
-		sources_in_bounds =  [i for i in xrange(len(RA)) if (RA[i]>=ra_lims[0] and RA[i]<=ra_lims[1]) and (Dec[i]>=dec_lims[0] and Dec[i]<=dec_lims[1])]
 		area = get_lune(ra_lims[0],ra_lims[1],dec_lims[0],dec_lims[1])
-	##If they do, searching the coords slightly differently and do some rearranging to get the area
+	##If they do, do some rearranging to get the area
 	else:
-		sources_in_bounds =  [i for i in xrange(len(RA)) if (RA[i]>=ra_lims[0] or RA[i]<=ra_lims[1]) and (Dec[i]>=dec_lims[0] and Dec[i]<=dec_lims[1])]
 		extra = 360.0 - ra_lims[0]
 		area = get_lune(0,ra_lims[1]+extra,dec_lims[0],dec_lims[1])
-	scaled_source_density = (4*np.pi*len(sources_in_bounds))/area
-
-	##Create a new table, and populate with the data in correct units
-	t=Table(masked=True,meta={'src_dens':scaled_source_density})
-	t_names = Column(name='%s_name' %prefix,data=names,description='Name from catalogue',dtype=str)
-	t_ras = Column(name='%s_RAJ2000' %prefix,data=RA,description='Right Ascension of source (J2000)',unit='deg',dtype=float)
-	t_rerrs = Column(name='%s_e_RAJ2000' %prefix,data=RA_error,description='Error on Right Ascension',unit='deg',dtype=float)
-	t_decs = Column(name='%s_DEJ2000' %prefix,data=Dec,description='Declination of source (J2000)',unit='deg',dtype=float)
-	t_derrs = Column(name='%s_e_DEJ2000' %prefix,data=Dec_error,description='Error on Declination',unit='deg',dtype=float)
-	t_fluxes = Column(name='%s_S%d' %(prefix,float(freq)),data=flux,description='Source flux at %.1fMHz' %float(freq),unit='Jy',dtype=float)
-	t_ferrs = Column(name='%s_e_S%d' %(prefix,float(freq)),data=flux_error,description='Error on flux at %.1fMHz' %float(freq),unit='Jy',dtype=float)
-	t_majors = Column(name='%s_MajAxis' %prefix,data=major,description='Fitted major axis',unit='deg',dtype=float)
-	t_minors = Column(name='%s_MinAxis' %prefix,data=minor,description='Fitted minor axis',unit='deg',dtype=float)
-	t_PAs = Column(name='%s_PA' %prefix,data=PA,description='Fitted Position Angle',unit='deg',dtype=float)
-	mask = []
-	for i in flags:
-		if type(i)==np.ma.core.MaskedConstant: mask.append(True)
-		else: mask.append(False)
-	t_flags = MaskedColumn(name='%s_flag' %prefix,data=flags,description='Any meta flag for inclusion',mask=mask,fill_value='--',dtype=str)
-	mask = []
-	for i in ID:
-		if type(i)==np.ma.core.MaskedConstant: mask.append(True)
-		else: mask.append(False)
-	t_fields = MaskedColumn(name='%s_FieldID' %prefix,data=ID,description='If avaiable, image field ID',mask=mask,fill_value='--',dtype=str)
-
-	t.add_columns([t_names,t_ras,t_rerrs,t_decs,t_derrs,t_fluxes,t_ferrs,t_majors,t_minors,t_PAs,t_flags,t_fields])
-	#Again, handles multiple frequencies in one catalogues
-	if len(freqs)>0:
-		for i in xrange(len(freqs)):
-			t_fextra = Column(name='%s_Flux_%.1f' %(prefix,float(freqs[i])),data=fluxs[i],description='Source flux at %.1fMHz' %float(freqs[i]),unit='Jy',dtype=float)
-			t_ferrextra = Column(name='%s_Flux_%.1f_err' %(prefix,float(freqs[i])),data=ferrs[i],description='Error on flux at %.1fMHz' %float(freqs[i]),unit='Jy',dtype=float)
-			t.add_columns([t_fextra,t_ferrextra])
-
-	##Add the source density to the table
-	#t.add_keyword('%s_nu' %prefix,str(scaled_source_density))
-	t.write('simple_%s.fits' %prefix,overwrite=True,format='fits')
-
-	return scaled_source_density
+	return (4*np.pi*num_in_bounds)/area
+
+def write_simple(columns,details,prefix,scaled_source_density):
+	'''Writes the simple table to simple_<prefix>.fits. If --chunk_size is set, the
+	table is created and written chunk_size rows at a time'''
+	if options.chunk_size:
+		entries = len(columns['RAJ2000'])
+		tables = (cml.make_table(cml.take_rows(columns,slice(start,stop)),details,prefix,scaled_source_density) for start,stop in cml.get_chunks(entries,int(options.chunk_size)))
+		cml.write_table_chunks('simple_%s.fits' %prefix,tables,entries)
+	else:
+		t = cml.make_table(columns,details,prefix,scaled_source_density)
+		t.write('simple_%s.fits' %prefix,overwrite=True,format='fits')
 
 
 ##Read in all of the user inputs and use them to create the simple tables
 prefix1 = options.prefix1
-prefix2 = options.prefix2
 details1 = options.details1.split(',')
-details2 = options.details2.split(',')
 units1 = options.units1.split(',')
-units2 = options.units2.split(',')
-ra_lims1 = map(float,options.ra_lims1.split(','))
-ra_lims2 = map(float,options.ra_lims2.split(','))
-dec_lims1 = map(float,options.dec_lims1.split(','))
-dec_lims2 = map(float,options.dec_lims2.split(','))
-
-def read_table(name):
-	'''Read in a table and work out if its .vot or .fits, and grab the
-	data accordingly. If not the right format, exit the whole process'''
-	if '.vot' in name:
-		table = vot_parse(name,pedantic=False).get_first_table()
-		data = table.array
-		return data
-	elif '.fits' or '.FITS' in name:
-		table = fits.open(name,pedantic=False)
-		return table[1].data
-	else:
-		sys.exit('Entered table must either be VOTable or FITS')
-
-##Read in the table data
-data1 = read_table(options.table1)
-data2 = read_table(options.table2)
-
-ss_dens1 = make_table(data1,details1,units1,prefix1,ra_lims1,dec_lims1)
-ss_dens2 = make_table(data2,details2,units2,prefix2,ra_lims2,dec_lims2)
 
-##Using the appropriate user values, run stilts to produce a cross matched
-##table with all possible matches and all possible information included
-##First create a string with all the commands in
-match_string = 'stilts tmatch2 join=1and2 find=all matcher=sky params=%d ' %float(options.separation)
-match_string += "in1=simple_%s.fits values1='%s_RAJ2000 %s_DEJ2000' suffix1='' " %(prefix1,prefix1,prefix1)
-match_string += "in2=simple_%s.fits values2='%s_RAJ2000 %s_DEJ2000' suffix2='' " %(prefix2,prefix2,prefix2)
-match_string += "fixcols=all out=matched_%s_%s.fits" %(prefix1,prefix2)
-
-##Run the stilts match
-subprocess.call(match_string,shell=True)
-
-if options.make_table:
-	pass
+def get_lims(lims):
+	'''Turns an entered set of lims into floats. The lims are only needed
+	if not using --density_cell, so exit if they are missing'''
+	if lims is None:
+		if not options.density_cell: sys.exit('Must enter the --ra_lims and --dec_lims of every catalogue, unless using --density_cell')
+		return None
+	return map(float,lims.split(','))
+
+ra_lims1 = get_lims(options.ra_lims1)
+dec_lims1 = get_lims(options.dec_lims1)
+
+if options.chunk_size and not options.cache_dir:
+	sys.exit('--chunk_size needs --cache_dir to be set, as the normalised tables are written there a chunk at a time')
+if options.pairs and (not options.cache_dir or options.matcher=='stilts'):
+	sys.exit('--pairs needs --cache_dir to be set and the native matcher, as the pairs point at the cached normalised tables')
+
+##Every *2 option is given once per catalogue to match to table1
+tables2 = options.table2
+prefixes2 = options.prefix2
+all_details2 = [details.split(',') for details in options.details2]
+all_units2 = [units.split(',') for units in options.units2]
+all_ra_lims2 = map(get_lims,options.ra_lims2 or [None]*len(tables2))
+all_dec_lims2 = map(get_lims,options.dec_lims2 or [None]*len(tables2))
+if len(set(map(len,[tables2,prefixes2,all_details2,all_units2,all_ra_lims2,all_dec_lims2])))!=1:
+	sys.exit('Must enter the same number of --table2, --details2, --units2, --prefix2, --ra_lims2 and --dec_lims2')
+
+##Each catalogue pair can have its own matching radius, and with --sigma each
+##source pair gets one from the positional errors
+if options.separation2:
+	if len(options.separation2)!=len(tables2):
+		sys.exit('If using --separation2, enter it once for every --table2')
+	separations2 = map(float,options.separation2)
+elif options.separation:
+	separations2 = [float(options.separation)]*len(tables2)
 else:
-	cwd = os.getcwd()
-	subprocess.call('rm %s/simple_%s.fits %s/simple_%s.fits' %(cwd,prefix1,cwd,prefix2),shell=True)
-
-##Add the calculated scaled source density of each catalogue to
-###the stilts matched catalogue for use by calculate_bayes.py
-stilts_table = fits.open("matched_%s_%s.fits" %(prefix1,prefix2))
-match_data = stilts_table[1].data
+	sys.exit('Enter a matching radius with --separation, or with --separation2 for every --table2')
+adaptive = options.separation2 or options.sigma
+##Pairs and combinations avoided by the adaptive radius can only be counted
+##when a wider --separation was searched as a baseline
+baseline = adaptive and options.separation and (options.sigma or min(separations2)<float(options.separation))
+if (adaptive or options.density_cell or options.groups) and options.matcher=='stilts':
+	sys.exit('--separation2, --sigma, --density_cell and --groups only work with the native matcher')
 
-match_table = Table(data=match_data,meta={"nu_1":ss_dens1,"nu_2":ss_dens2})
-match_table.write("matched_%s_%s.fits" %(prefix1,prefix2),overwrite=True,format='fits')
+def read_table(name):
+	'''Opens a table through table_access_lib, so only the columns named in the
+	details get read. Tables inside .tar.bz2 archives are decompressed straight
+	into memory'''
+	if cml.is_archive(name):
+		member_name,infile = cml.read_archive(name)
+		return tal.open_table(member_name,infile)
+	return tal.open_table(name)
+
+def normalise(name,details,units):
+	'''Reads in a table and normalises the columns, reporting how quickly it went'''
+	start = time.time()
+	data = read_table(name)
+	columns = cml.normalise_table(data,details,units)
+	took = time.time() - start
+	print 'Normalised %d rows of %s in %.2fs (%.0f rows/s, column bytes used %.2f of %.2f MB)' %(len(data),name,took,len(data)/max(took,1e-6),data.bytes_used/1024.0**2,data.total_bytes/1024.0**2)
+	return columns
+
+def normalise_chunked(name,details,units,store_dir,meta):
+	'''Normalises a FITS table --chunk_size rows at a time, writing each chunk straight
+	into the cache, so that memory use depends on the chunk size and not the
+	size of the table'''
+	start_time = time.time()
+	data = read_table(name)
+	entries = len(data)
+	for start,stop in cml.get_chunks(entries,int(options.chunk_size)):
+		chunk = cml.normalise_table(data[start:stop],details,units)
+		##The first chunk tells us the type of every column
+		if start==0:
+			temp_dir,columns = csl.create_store(store_dir,dict([(col_name,column.dtype) for col_name,column in chunk.items()]),entries)
+		for col_name,column in chunk.items():
+			columns[col_name][start:stop] = column
+	csl.finish_store(temp_dir,store_dir,columns,meta)
+	took = time.time() - start_time
+	print 'Normalised %d rows of %s in chunks of %s in %.2fs (%.0f rows/s, column bytes used %.2f of %.2f MB)' %(entries,name,options.chunk_size,took,entries/max(took,1e-6),data.bytes_used/1024.0**2,data.total_bytes/1024.0**2)
+
+##The cache stores used in this run, which eviction must never delete while
+##they are still memory-mapped
+cache_keys = []
+
+def load_simple(name,details,units,ra_lims,dec_lims):
+	'''Reads and normalises a table, returning the normalised columns, the scaled
+	source density and the cache store it lives in. If --cache_dir is set, the
+	normalised columns are stored in the cache the first time, and memory-mapped
+	from there on every run after, so the original table is only read once'''
+	if not options.cache_dir:
+		columns = normalise(name,details,units)
+		return columns,get_source_density(columns['RAJ2000'],columns['DEJ2000'],ra_lims,dec_lims),None
+
+	key = csl.cache_key(name,','.join(details),','.join(units))
+	store_dir = os.path.join(options.cache_dir,key)
+	cache_keys.append(key)
+	columns,meta = csl.load_store(store_dir)
+	if columns is None:
+		if not os.path.isdir(options.cache_dir): os.makedirs(options.cache_dir)
+		meta = {'table':os.path.abspath(name),'src_dens':{}}
+		##VOTables can't be read in part, so only FITS tables are done in chunks
+		if options.chunk_size and '.vot' not in name:
+			normalise_chunked(name,details,units,store_dir,meta)
+		else:
+			csl.save_store(store_dir,normalise(name,details,units),meta)
+		csl.evict_cache(options.cache_dir,float(options.cache_size)*1024**2,keep=cache_keys)
+		columns,meta = csl.load_store(store_dir)
+
+	##The source density depends on the lune as well, so store one per set of lims
+	if ra_lims is None: return columns,None,os.path.abspath(store_dir)
+	lims = '%s,%s,%s,%s' %(ra_lims[0],ra_lims[1],dec_lims[0],dec_lims[1])
+	if lims in meta['src_dens']:
+		scaled_source_density = meta['src_dens'][lims]
+	else:
+		scaled_source_density = get_source_density(columns['RAJ2000'],columns['DEJ2000'],ra_lims,dec_lims)
+		meta['src_dens'][lims] = scaled_source_density
+		csl.update_meta(store_dir,src_dens=meta['src_dens'])
+	return columns,scaled_source_density,os.path.abspath(store_dir)
+
+def get_local_density(columns,scaled_source_density):
+	'''With --density_cell, returns the local scaled source density of every source.
+	If no lune was entered, the density over the catalogue footprint is used as
+	the single scaled source density'''
+	if not options.density_cell: return None,scaled_source_density
+	chunk_size = None
+	if options.chunk_size: chunk_size = int(options.chunk_size)
+	nus,footprint_density = cml.local_density(columns['RAJ2000'],columns['DEJ2000'],float(options.density_cell),chunk_size)
+	if scaled_source_density is None: scaled_source_density = footprint_density
+	return nus,scaled_source_density
+
+##Read in the table data, and normalise the columns. table1 is only read
+##and indexed once, however many catalogues it is matched to. The simple
+##tables only get written to disk if asked for, or if stilts needs them
+write_simples = options.make_table or options.matcher=='stilts'
+columns1,ss_dens1,store1 = load_simple(options.table1,details1,units1,ra_lims1,dec_lims1)
+nus1,ss_dens1 = get_local_density(columns1,ss_dens1)
+if write_simples: write_simple(columns1,details1,prefix1,ss_dens1)
+if options.matcher=='native':
+	##With --cache_dir, every table2 is matched through a zone index saved in
+	##the cache, so table1 never needs a KD-tree
+	if not options.cache_dir and int(options.workers)==1:
+		index1 = cml.sky_index(columns1['RAJ2000'],columns1['DEJ2000'])
+	sigma1 = None
+	if options.sigma: sigma1 = cml.position_sigma(columns1['e_RAJ2000'],columns1['e_DEJ2000'])
+	##The number of matches of each table1 source in each catalogue, within the --separation
+	##baseline and within the adaptive radius, to report how many combinations were avoided
+	fixed_counts = np.zeros((len(columns1['RAJ2000']),len(tables2)),dtype=int)
+	adaptive_counts = np.zeros((len(columns1['RAJ2000']),len(tables2)),dtype=int)
+	##The matched pairs and names of every catalogue, for --groups
+	group_links = []
+	group_names = [columns1['name']]
+elif options.matcher!='stilts':
+	sys.exit('--matcher must either be native or stilts')
+
+for cat_ind,(table2,details2,units2,prefix2,ra_lims2,dec_lims2) in enumerate(zip(tables2,all_details2,all_units2,prefixes2,all_ra_lims2,all_dec_lims2)):
+	columns2,ss_dens2,store2 = load_simple(table2,details2,units2,ra_lims2,dec_lims2)
+	nus2,ss_dens2 = get_local_density(columns2,ss_dens2)
+	if write_simples: write_simple(columns2,details2,prefix2,ss_dens2)
+
+	if options.matcher=='stilts':
+		##Using the appropriate user values, run stilts to produce a cross matched
+		##table with all possible matches and all possible information included
+		##First create a string with all the commands in
+		match_string = 'stilts tmatch2 join=1and2 find=all matcher=sky params=%d ' %float(options.separation)
+		match_string += "in1=simple_%s.fits values1='%s_RAJ2000 %s_DEJ2000' suffix1='' " %(prefix1,prefix1,prefix1)
+		match_string += "in2=simple_%s.fits values2='%s_RAJ2000 %s_DEJ2000' suffix2='' " %(prefix2,prefix2,prefix2)
+		match_string += "fixcols=all out=matched_%s_%s.fits" %(prefix1,prefix2)
+
+		##Run the stilts match
+		subprocess.call(match_string,shell=True)
+		if not options.make_table: os.remove('simple_%s.fits' %prefix2)
+
+		##stilts can only write to disk, so add the calculated scaled source density
+		##of each catalogue to the stilts matched catalogue for use by calculate_bayes.py
+		stilts_table = fits.open("matched_%s_%s.fits" %(prefix1,prefix2))
+		match_data = stilts_table[1].data
+
+		match_table = Table(data=match_data,meta={"nu_1":ss_dens1,"nu_2":ss_dens2})
+		match_table.write("matched_%s_%s.fits" %(prefix1,prefix2),overwrite=True,format='fits')
+	else:
+		##Find all pairs within the separation using a KD-tree on the unit sphere,
+		##and join the matched rows in the same way as stilts would. With --workers
+		##the sky is split into declination strips matched in parallel. With --cache_dir
+		##table2 is matched through its zone index, which is built once and memory-mapped
+		##from the cache after, --chunk_size rows of table1 at a time. The zone index is
+		##built --chunk_size rows at a time too. Search out to the larger of --separation
+		##(if given) and --separation2, so the pairs avoided can be counted
+		search = max(float(options.separation or 0.0),separations2[cat_ind])
+		if int(options.workers)>1:
+			ind1,ind2,seps = cml.match_sky_tiled(columns1['RAJ2000'],columns1['DEJ2000'],columns2['RAJ2000'],columns2['DEJ2000'],search,int(options.workers))
+		elif options.cache_dir:
+			chunk_size = None
+			if options.chunk_size: chunk_size = int(options.chunk_size)
+			start = time.time()
+			index2 = cml.load_zone_index(store2,columns2['RAJ2000'],columns2['DEJ2000'],chunk_size)
+			print 'Opened zone index of %s (%d rows) in %.3fs' %(prefix2,index2.entries,time.time() - start)
+			##Building the zone index adds to the cache, so evict again
+			csl.evict_cache(options.cache_dir,float(options.cache_size)*1024**2,keep=cache_keys)
+			ind1,ind2,seps = cml.match_zones(columns1['RAJ2000'],columns1['DEJ2000'],index2,search,chunk_size)
+		else:
+			index2 = cml.sky_index(columns2['RAJ2000'],columns2['DEJ2000'])
+			ind1,ind2,seps = cml.match_sky(index1,index2,search)
+
+		##Cut the pairs down to the catalogue pair radius and the n-sigma error
+		##radius before they ever reach calculate_bayes.py
+		if adaptive:
+			##Every pair found is within the search radius, so the adaptive radius can
+			##only ever keep some of them
+			if baseline: fixed_counts[:,cat_ind] = np.bincount(ind1,minlength=len(fixed_counts))
+			sigma2 = None
+			if options.sigma: sigma2 = cml.position_sigma(columns2['e_RAJ2000'],columns2['e_DEJ2000'])
+			keep = cml.adaptive_keep(ind1,ind2,seps,separations2[cat_ind],sigma1,sigma2,options.sigma)
+			print 'Kept %d of the %d pairs between %s and %s within the search radius of %s arcsec' %(keep.sum(),len(keep),prefix1,prefix2,search)
+			ind1,ind2,seps = ind1[keep],ind2[keep],seps[keep]
+			if baseline: adaptive_counts[:,cat_ind] = np.bincount(ind1,minlength=len(adaptive_counts))
+		if options.groups:
+			group_links.append((ind1,ind2))
+			group_names.append(columns2['name'])
+
+		##With --pairs only the row indexes and separations are written, with the
+		##cached stores standing in for the rest of the matched table
+		if options.pairs:
+			meta = {'store1':store1,'store2':store2,'details1':details1,'details2':details2,
+				'prefix1':prefix1,'prefix2':prefix2,'nu_1':ss_dens1,'nu_2':ss_dens2}
+			if options.density_cell:
+				cml.save_pairs('pairs_%s_%s' %(prefix1,prefix2),ind1,ind2,seps,meta,nus1[ind1],nus2[ind2])
+			else:
+				cml.save_pairs('pairs_%s_%s' %(prefix1,prefix2),ind1,ind2,seps,meta)
+			continue
+
+		matched1 = cml.make_table(cml.take_rows(columns1,ind1),details1,prefix1,ss_dens1)
+		matched2 = cml.make_table(cml.take_rows(columns2,ind2),details2,prefix2,ss_dens2)
+		match_table = cml.make_matched_table(matched1,matched2,seps)
+		if options.density_cell: cml.add_local_density(match_table,prefix1,nus1[ind1],prefix2,nus2[ind2])
+
+		##Add the calculated scaled source density of each catalogue for use by
+		##calculate_bayes.py, so the matched table only needs writing once
+		match_table.meta = {"nu_1":ss_dens1,"nu_2":ss_dens2}
+		match_table.write('matched_%s_%s.fits' %(prefix1,prefix2),overwrite=True,format='fits')
+
+if options.matcher=='stilts' and not options.make_table:
+	os.remove('simple_%s.fits' %prefix1)
+
+if options.matcher=='native' and baseline:
+	fixed_pairs,adaptive_pairs = fixed_counts.sum(),adaptive_counts.sum()
+	fixed_combs,adaptive_combs = cml.count_combinations(fixed_counts),cml.count_combinations(adaptive_counts)
+	print 'Adaptive radius avoided %d of %d pairs and %d of %d combinations' %(fixed_pairs-adaptive_pairs,fixed_pairs,fixed_combs-adaptive_combs,fixed_combs)
+
+##Link every matched source into groups, so that sources matched to more than
+##one table1 source end up in the same group as all of them. This is for
+##information only, as calculate_bayes.py doesn't read groups_<prefix1>.fits
+if options.groups:
+	start = time.time()
+	cats,rows,group_ids,group_sizes = cml.find_groups(group_links,len(group_names[0]),[len(names) for names in group_names[1:]])
+	took = time.time() - start
+	prefixes = np.array([prefix1] + prefixes2)
+	names = np.empty(len(rows),dtype=object)
+	for cat_ind,cat_names in enumerate(group_names):
+		in_cat = cats==cat_ind
+		names[in_cat] = np.asarray(cat_names)[rows[in_cat]]
+	t = Table()
+	t.add_columns([Column(name='Catalogue',data=prefixes[cats],description='Prefix of the catalogue the source is from',dtype=str),
+		Column(name='Row',data=rows,description='Row of the source in its catalogue',dtype=int),
+		Column(name='Name',data=names.astype(str),description='Name from catalogue',dtype=str),
+		Column(name='GroupID',data=group_ids,description='Friends-of-friends group the source is linked into',dtype=int),
+		Column(name='GroupSize',data=group_sizes,description='Number of sources in the group',dtype=int)])
+	t.write('groups_%s.fits' %prefix1,overwrite=True,format='fits')
+	num_groups = group_ids.max() + 1 if len(group_ids) else 0
+	print 'Grouped %d sources from %d pairs into %d groups (largest %d) in %.3fs' %(len(rows),sum([len(links[0]) for links in group_links]),num_groups,group_sizes.max() if len(group_sizes) else 0,took)
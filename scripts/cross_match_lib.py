@@ -0,0 +1,771 @@
+#!/usr/bin/python
+import numpy as np
+import sys
+import os
+import subprocess
+import tarfile
+from distutils.spawn import find_executable
+import catalogue_store_lib as csl
+from multiprocessing import Pool
+from scipy.spatial import cKDTree
+from astropy.table import Table, Column, MaskedColumn, hstack
+from io import BytesIO
+try:
+	import pyfits as fits
+except ImportError:
+	from astropy.io import fits
+
+dr = np.pi/180.0
+
+##Factors to convert each of the units that can be entered by the user into
+##deg (for angles) or Jy (for fluxes). Add any new units here
+unit_factors = {'angle':{'deg':1.0,'arcmin':1.0/60.0,'arcsec':1.0/3600.0,'min':15.0/60.0,'sec':15.0/3600.0},
+	'flux':{'Jy':1.0,'mJy':1.0/1000.0}}
+
+##NORMALISING FUNCTIONS+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+def get_factor(unit,unit_type):
+	'''Looks up the conversion factor for a unit in unit_factors'''
+	try:
+		return unit_factors[unit_type][unit]
+	except KeyError:
+		sys.exit('%s is not a recognised %s unit - choose from %s' %(unit,unit_type,','.join(sorted(unit_factors[unit_type].keys()))))
+
+def to_float(column,blank=-100000.0):
+	'''Converts a whole column to floats in one go. Returns the converted column and
+	a boolean array that is True wherever the entry was masked, empty or not a number.
+	Those entries are set to blank'''
+	values = np.ma.getdata(column)
+	bad = np.ma.getmaskarray(column).copy()
+	if values.dtype.kind in 'biuf':
+		converted = values.astype(float)
+	else:
+		##String typed numbers. Convert everything that isn't blank in bulk, and only
+		##if that fails, convert the unique strings one at a time to find the bad ones
+		strings = np.char.strip(np.asarray(values).astype(str))
+		bad |= (strings=='')
+		converted = np.empty(len(strings)); converted.fill(blank)
+		try:
+			converted[~bad] = strings[~bad].astype(float)
+		except ValueError:
+			uniques,inverse = np.unique(strings[~bad],return_inverse=True)
+			unique_floats = np.empty(len(uniques))
+			unique_bad = np.zeros(len(uniques),dtype=bool)
+			for i,string in enumerate(uniques):
+				try:
+					unique_floats[i] = float(string)
+				except ValueError:
+					unique_bad[i] = True
+			good_inds = np.where(~bad)[0]
+			converted[good_inds] = unique_floats[inverse]
+			bad[good_inds[unique_bad[inverse]]] = True
+	converted[bad] = blank
+	return converted,bad
+
+def get_units(data,detail,unit,unit_type,entries):
+	'''Either returns an array of -100000.0s of a given length (if detail is -), or
+	takes the detail column from data and converts it to deg or Jy. Works on the
+	whole column at once, and any masked, empty or non-numeric entries are
+	returned as -100000.0'''
+	if detail=='-':
+		column = np.empty(entries); column.fill(-100000.0)
+		return column
+	factor = get_factor(unit,unit_type)
+	column,bad = to_float(data[detail])
+	column[~bad] *= factor
+	return column
+
+def get_mask(column):
+	'''Returns a boolean array that is True wherever column is masked'''
+	return np.ma.getmaskarray(column).copy()
+
+def normalise_table(data,details,units):
+	'''Find all of the data in the columns as specified by the
+	user inputs, convert to deg and Jy, and return them as a dictionary
+	of arrays. These are the columns that get stored by the cache'''
+	shape = data.shape
+	entries = shape[0]
+	columns = {}
+	columns['name'] = np.asarray(data[details[0]]).astype(str)
+	columns['RAJ2000'] = get_units(data,details[1],units[0],'angle',entries)
+	columns['e_RAJ2000'] = get_units(data,details[2],units[1],'angle',entries)
+	columns['DEJ2000'] = get_units(data,details[3],units[2],'angle',entries)
+	columns['e_DEJ2000'] = get_units(data,details[4],units[3],'angle',entries)
+	columns['S'] = get_units(data,details[6],units[4],'flux',entries)
+	columns['e_S'] = get_units(data,details[7],units[5],'flux',entries)
+	columns['PA'] = get_units(data,details[8],units[6],'angle',entries)
+	columns['MajAxis'] = get_units(data,details[9],units[7],'angle',entries)
+	columns['MinAxis'] = get_units(data,details[10],units[8],'angle',entries)
+
+	##Flags and field IDs are kept as strings, with any masked entries noted
+	for name,detail in [('flag',details[11]),('FieldID',details[12])]:
+		if detail=='-':
+			column = np.empty(entries); column.fill(-100000.0)
+			columns[name] = column.astype(str)
+			columns['%s_mask' %name] = np.zeros(entries,dtype=bool)
+		else:
+			columns[name] = np.asarray(np.ma.getdata(data[detail])).astype(str)
+			columns['%s_mask' %name] = get_mask(data[detail])
+
+	##This handles the case of more than one frequency in a single catalogue
+	if len(details)>13:
+		length = len(details) - 13
+		num_of_freqs = length / 3
+		for i in xrange(num_of_freqs):
+			columns['Flux_%d' %i] = get_units(data,details[13+1+(3*i)],units[9+(2*i)],'flux',entries)
+			columns['Flux_%d_err' %i] = get_units(data,details[13+2+(3*i)],units[10+(2*i)],'flux',entries)
+	return columns
+
+def make_table(columns,details,prefix,scaled_source_density):
+	'''Takes the normalised columns and creates a simple table with the
+	column names that the rest of PUMA expects'''
+	freq = details[5]
+	freqs = details[13::3]
+
+	##Create a new table, and populate with the data in correct units
+	t=Table(masked=True,meta={'src_dens':scaled_source_density})
+	t_names = Column(name='%s_name' %prefix,data=columns['name'],description='Name from catalogue',dtype=str)
+	t_ras = Column(name='%s_RAJ2000' %prefix,data=columns['RAJ2000'],description='Right Ascension of source (J2000)',unit='deg',dtype=float)
+	t_rerrs = Column(name='%s_e_RAJ2000' %prefix,data=columns['e_RAJ2000'],description='Error on Right Ascension',unit='deg',dtype=float)
+	t_decs = Column(name='%s_DEJ2000' %prefix,data=columns['DEJ2000'],description='Declination of source (J2000)',unit='deg',dtype=float)
+	t_derrs = Column(name='%s_e_DEJ2000' %prefix,data=columns['e_DEJ2000'],description='Error on Declination',unit='deg',dtype=float)
+	t_fluxes = Column(name='%s_S%d' %(prefix,float(freq)),data=columns['S'],description='Source flux at %.1fMHz' %float(freq),unit='Jy',dtype=float)
+	t_ferrs = Column(name='%s_e_S%d' %(prefix,float(freq)),data=columns['e_S'],description='Error on flux at %.1fMHz' %float(freq),unit='Jy',dtype=float)
+	t_majors = Column(name='%s_MajAxis' %prefix,data=columns['MajAxis'],description='Fitted major axis',unit='deg',dtype=float)
+	t_minors = Column(name='%s_MinAxis' %prefix,data=columns['MinAxis'],description='Fitted minor axis',unit='deg',dtype=float)
+	t_PAs = Column(name='%s_PA' %prefix,data=columns['PA'],description='Fitted Position Angle',unit='deg',dtype=float)
+	t_flags = MaskedColumn(name='%s_flag' %prefix,data=columns['flag'],description='Any meta flag for inclusion',mask=columns['flag_mask'],fill_value='--',dtype=str)
+	t_fields = MaskedColumn(name='%s_FieldID' %prefix,data=columns['FieldID'],description='If avaiable, image field ID',mask=columns['FieldID_mask'],fill_value='--',dtype=str)
+
+	t.add_columns([t_names,t_ras,t_rerrs,t_decs,t_derrs,t_fluxes,t_ferrs,t_majors,t_minors,t_PAs,t_flags,t_fields])
+	#Again, handles multiple frequencies in one catalogues
+	if len(freqs)>0:
+		for i in xrange(len(freqs)):
+			t_fextra = Column(name='%s_Flux_%.1f' %(prefix,float(freqs[i])),data=columns['Flux_%d' %i],description='Source flux at %.1fMHz' %float(freqs[i]),unit='Jy',dtype=float)
+			t_ferrextra = Column(name='%s_Flux_%.1f_err' %(prefix,float(freqs[i])),data=columns['Flux_%d_err' %i],description='Error on flux at %.1fMHz' %float(freqs[i]),unit='Jy',dtype=float)
+			t.add_columns([t_fextra,t_ferrextra])
+
+	return t
+
+def take_rows(columns,inds):
+	'''Returns a dictionary of the normalised columns, but only for the rows in inds
+	(either an index array or a slice)'''
+	return dict([(name,np.asarray(column[inds])) for name,column in columns.items()])
+
+def get_chunks(entries,chunk_size):
+	'''Returns a list of (start,stop) row ranges that cover entries rows, chunk_size at a time'''
+	if entries==0: return [(0,0)]
+	return [(start,min(start+chunk_size,entries)) for start in xrange(0,entries,chunk_size)]
+
+def count_in_bounds(RA,Dec,ra_lims,dec_lims):
+	'''Counts the number of sources within a lune defined by ra_lims and dec_lims.
+	Accounts for the ra_lims crossing the RA = 0 line'''
+	RA = np.asarray(RA)
+	Dec = np.asarray(Dec)
+	in_dec = (Dec>=dec_lims[0]) & (Dec<=dec_lims[1])
+	if ra_lims[0]<ra_lims[1]:
+		in_ra = (RA>=ra_lims[0]) & (RA<=ra_lims[1])
+	else:
+		in_ra = (RA>=ra_lims[0]) | (RA<=ra_lims[1])
+	return int(np.count_nonzero(in_ra & in_dec))
+
+def write_table_chunks(name,tables,entries):
+	'''Writes a FITS table one chunk at a time, so the whole table never has to be
+	in memory. tables is an iterator of astropy Tables that all have the same columns,
+	and entries is the total number of rows they add up to'''
+	outfile = open(name,'wb')
+	fits.PrimaryHDU().writeto(outfile)
+	written = 0
+	for t in tables:
+		##Let astropy do the conversion to FITS for each chunk, then copy over just the data
+		hdu = fits.table_to_hdu(t)
+		buff = BytesIO()
+		fits.HDUList([fits.PrimaryHDU(),hdu]).writeto(buff)
+		data_size = hdu.header['NAXIS1']*hdu.header['NAXIS2']
+		padded_size = int(np.ceil(data_size/2880.0))*2880
+		data_start = len(buff.getvalue()) - padded_size
+		if written==0:
+			header = hdu.header.copy()
+			header['NAXIS2'] = entries
+			outfile.write(header.tostring().encode('ascii'))
+		outfile.write(buff.getvalue()[data_start:data_start+data_size])
+		written += len(t)
+	##Pad the data out to a whole number of FITS blocks
+	data_size = header['NAXIS1']*entries
+	outfile.write(b'\x00'*((2880 - data_size%2880)%2880))
+	outfile.close()
+
+##LOCAL DENSITY FUNCTIONS+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+class density_grid:
+	'''An iso-latitude grid of roughly equal area cells, in the spirit of HEALPix. The sky
+	is cut into Dec rings cell_size deg tall, and each ring into as many RA cells as
+	fit at cell_size deg wide, so the cells don't shrink towards the poles'''
+	def __init__(self,cell_size):
+		self.num_rings = max(int(np.ceil(180.0/cell_size)),1)
+		self.dec_edges = np.linspace(-90.0,90.0,self.num_rings+1)
+		dec_mids = (self.dec_edges[:-1] + self.dec_edges[1:]) / 2.0
+		self.ring_cells = np.maximum(np.round(360.0*np.cos(dec_mids*dr)/cell_size),1).astype(int)
+		self.ring_starts = np.concatenate(([0],np.cumsum(self.ring_cells)[:-1]))
+		self.num_cells = self.ring_cells.sum()
+		##Exact area of every cell in steradians
+		ring_areas = 2*np.pi*(np.sin(self.dec_edges[1:]*dr) - np.sin(self.dec_edges[:-1]*dr))
+		self.areas = np.repeat(ring_areas/self.ring_cells,self.ring_cells)
+
+	def cell_of(self,RA,Dec,ring=None):
+		'''Returns the cell number of every RA,Dec (deg). If ring is given, the cells in that
+		ring (array) are returned regardless of Dec'''
+		if ring is None:
+			ring = np.clip(((np.asarray(Dec,dtype=float)+90.0)/180.0*self.num_rings).astype(int),0,self.num_rings-1)
+		cells = self.ring_cells[ring]
+		ra_cell = (np.floor(np.mod(np.asarray(RA,dtype=float),360.0)/360.0*cells).astype(int)) % cells
+		return self.ring_starts[ring] + ra_cell
+
+	def neighbours(self):
+		'''Returns an (num_cells,9) array of each cell and the 8 cells around it, with any
+		repeats (in the small rings near the poles) marked as -1'''
+		ring = np.repeat(np.arange(self.num_rings),self.ring_cells)
+		ra_mid = ((np.arange(self.num_cells) - self.ring_starts[ring]) + 0.5) * (360.0/self.ring_cells[ring])
+		neighbours = []
+		for ring_step in [-1,0,1]:
+			near_ring = np.clip(ring + ring_step,0,self.num_rings-1)
+			width = 360.0/self.ring_cells[near_ring]
+			for ra_step in [-1,0,1]:
+				neighbours.append(self.cell_of(ra_mid + ra_step*width,None,ring=near_ring))
+		neighbours = np.sort(np.column_stack(neighbours),axis=1)
+		neighbours[:,1:][neighbours[:,1:]==neighbours[:,:-1]] = -1
+		return neighbours
+
+def local_density(RA,Dec,cell_size,chunk_size=None):
+	'''Calculates the scaled source density (4pi times the number of sources per steradian) around
+	every source, by binning the catalogue on to a density_grid with np.bincount and smoothing over
+	each cell and its 8 neighbours. Also returns the density over the whole catalogue footprint
+	(all cells with a source in), for use when no lune is given'''
+	grid = density_grid(cell_size)
+	entries = len(RA)
+	if chunk_size:
+		chunks = get_chunks(entries,chunk_size)
+	else:
+		chunks = [(0,entries)]
+	counts = np.zeros(grid.num_cells)
+	for start,stop in chunks:
+		counts += np.bincount(grid.cell_of(RA[start:stop],Dec[start:stop]),minlength=grid.num_cells)
+
+	neighbours = grid.neighbours()
+	used = neighbours>=0
+	near_counts = np.where(used,counts[neighbours],0).sum(axis=1)
+	near_areas = np.where(used,grid.areas[neighbours],0).sum(axis=1)
+	cell_density = 4*np.pi*near_counts/near_areas
+
+	densities = np.empty(entries)
+	for start,stop in chunks:
+		densities[start:stop] = cell_density[grid.cell_of(RA[start:stop],Dec[start:stop])]
+	footprint_density = 4*np.pi*entries/max(grid.areas[counts>0].sum(),1e-30)
+	return densities,footprint_density
+
+##ARCHIVE FUNCTIONS++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+##Tools to decompress bz2 with, fastest first. lbzip2 and pbzip2 decompress
+##many blocks at once across all cores. If none are installed, python does it
+bz2_tools = ['lbzip2','pbzip2','bzip2']
+
+def is_archive(name):
+	'''Works out if a table name is a bz2 compressed tar archive'''
+	return name.endswith('.tar.bz2') or name.endswith('.tbz2') or name.endswith('.tbz')
+
+def read_archive(name):
+	'''Streams the first FITS or VOTable out of a .tar.bz2 archive, straight into memory
+	so no unpacked copy is ever written to disk. Returns the name of the table in the
+	archive (so the format can be worked out) and a file-like object holding it'''
+	tools = [tool for tool in bz2_tools if find_executable(tool)]
+	if tools:
+		process = subprocess.Popen([tools[0],'-dc',name],stdout=subprocess.PIPE)
+		archive = tarfile.open(fileobj=process.stdout,mode='r|')
+	else:
+		process = None
+		archive = tarfile.open(name,mode='r|bz2')
+	member_name,table = None,None
+	for member in archive:
+		if member.isfile() and ('.vot' in member.name or '.fits' in member.name or '.FITS' in member.name):
+			member_name = member.name
+			table = BytesIO(archive.extractfile(member).read())
+			break
+	archive.close()
+	if process is not None:
+		process.stdout.close()
+		process.wait()
+	if table is None:
+		sys.exit('No FITS or VOTable found inside %s' %name)
+	return member_name,table
+
+##SKY MATCHING FUNCTIONS+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+def sky_to_cartesian(RA,Dec):
+	'''Takes arrays of RA,Dec in deg and returns an (N,3) array of unit vectors.
+	Working on the unit sphere means RA = 0/360 and the poles need no special treatment'''
+	RA = np.asarray(RA,dtype=float)*dr
+	Dec = np.asarray(Dec,dtype=float)*dr
+	cos_dec = np.cos(Dec)
+	return np.column_stack((cos_dec*np.cos(RA),cos_dec*np.sin(RA),np.sin(Dec)))
+
+def arcsec_to_chord(separation):
+	'''Converts an angular separation in arcsec to the straight line distance
+	between two points on the unit sphere'''
+	return 2.0*np.sin((np.asarray(separation,dtype=float)/3600.0)*dr/2.0)
+
+def chord_to_arcsec(chord):
+	'''Converts a straight line distance between two points on the unit sphere
+	to an angular separation in arcsec'''
+	return (2.0*np.arcsin(np.clip(np.asarray(chord,dtype=float)/2.0,0.0,1.0))/dr)*3600.0
+
+class sky_index:
+	'''A KD-tree built on the unit vectors of a catalogue. Build once per catalogue
+	and query against as many other catalogues as needed'''
+	def __init__(self,RA,Dec):
+		self.xyz = sky_to_cartesian(RA,Dec)
+		self.tree = cKDTree(self.xyz)
+		self.entries = self.xyz.shape[0]
+
+def match_sky(index1,index2,separation):
+	'''Finds all pairs of sources between two sky_index classes that lie within separation (arcsec)
+	of each other - the equivalent of stilts tmatch2 find=all matcher=sky. Returns the row
+	indexes into each catalogue and the separation (arcsec), sorted by catalogue 1 row
+	and then by separation'''
+	##Pad the chord slightly so floating point noise doesn't lose pairs
+	##right on the limit, then cut on the exact separation afterwards
+	chord = arcsec_to_chord(separation)
+	pairs = index1.tree.sparse_distance_matrix(index2.tree,chord*(1+1e-9),output_type='ndarray')
+	ind1 = pairs['i'].astype(int)
+	ind2 = pairs['j'].astype(int)
+	seps = chord_to_arcsec(pairs['v'])
+
+	keep = seps<=float(separation)
+	ind1,ind2,seps = ind1[keep],ind2[keep],seps[keep]
+
+	order = np.lexsort((ind2,seps,ind1))
+	return ind1[order],ind2[order],seps[order]
+
+##Height in deg of the Dec zones used by zone_index. Any matching radius works
+##with any height, it only changes how many zones get searched
+zone_height = 0.05
+##Bump this if the layout of a saved zone_index ever changes
+zone_version = '1'
+
+class zone_index:
+	'''Sources sorted into Dec zones zone_height deg tall, and by RA within each zone, along
+	with their unit vectors in the same order. Everything is a plain array, so an index
+	can be saved in the cache and memory-mapped back, rather than rebuilt every run.
+	Each source is sorted on a key of zone*512 + RA, so a searchsorted on the keys
+	finds any RA range in any zone'''
+	def __init__(self,columns):
+		self.order = columns['order']
+		self.keys = columns['keys']
+		self.x = columns['x']
+		self.y = columns['y']
+		self.z = columns['z']
+		self.entries = len(self.keys)
+		self.num_zones = int(np.ceil(180.0/zone_height))
+
+def get_zones(Dec,num_zones):
+	'''Returns the Dec zone of every Dec (deg)'''
+	return np.clip(np.floor((np.asarray(Dec,dtype=float)+90.0)/zone_height),0,num_zones-1).astype(np.int64)
+
+def build_zone_index(RA,Dec):
+	'''Sorts a catalogue into zones, returning the columns of a zone_index'''
+	RA = np.mod(np.asarray(RA,dtype=float),360.0)
+	RA[RA>=360.0] = 0.0
+	keys = get_zones(Dec,int(np.ceil(180.0/zone_height)))*512.0 + RA
+	order = np.argsort(keys,kind='mergesort')
+	xyz = sky_to_cartesian(RA[order],np.asarray(Dec,dtype=float)[order])
+	return {'order':order.astype(np.int64),'keys':keys[order],'x':xyz[:,0].copy(),'y':xyz[:,1].copy(),'z':xyz[:,2].copy()}
+
+def save_zone_index(index_dir,RA,Dec,meta,chunk_size):
+	'''Builds the same zone_index as build_zone_index, but chunk_size rows at a time straight
+	into a store at index_dir, so the catalogue is never in memory all at once. Sources are
+	counted into zones, copied into their zone in row order, and then each run of whole
+	zones (roughly chunk_size rows) is sorted on RA'''
+	entries = len(RA)
+	num_zones = int(np.ceil(180.0/zone_height))
+	chunks = get_chunks(entries,chunk_size)
+	zone_counts = np.zeros(num_zones,dtype=np.int64)
+	for start,stop in chunks:
+		zone_counts += np.bincount(get_zones(Dec[start:stop],num_zones),minlength=num_zones)
+	zone_ends = np.cumsum(zone_counts)
+	zone_starts = zone_ends - zone_counts
+	temp_dir,columns = csl.create_store(index_dir,{'order':np.int64,'keys':float,'x':float,'y':float,'z':float},entries)
+	##Copy every source into its zone, keeping row order within each zone. Until the
+	##zones are sorted, keys holds the RA and x the Dec
+	filled = zone_starts.copy()
+	for start,stop in chunks:
+		ra = np.mod(np.asarray(RA[start:stop],dtype=float),360.0)
+		ra[ra>=360.0] = 0.0
+		zones = get_zones(Dec[start:stop],num_zones)
+		order = np.argsort(zones,kind='mergesort')
+		zones = zones[order]
+		positions = filled[zones] + np.arange(len(zones)) - np.searchsorted(zones,zones,side='left')
+		columns['order'][positions] = order + start
+		columns['keys'][positions] = ra[order]
+		columns['x'][positions] = np.asarray(Dec[start:stop],dtype=float)[order]
+		filled += np.bincount(zones,minlength=num_zones)
+	##Sort each run of zones on their keys. Rows only ever move within their zone, so
+	##this is the same order a sort of the whole catalogue would give
+	zone = 0
+	while zone<num_zones:
+		last = max(zone,np.searchsorted(zone_ends,zone_starts[zone] + chunk_size,side='right') - 1)
+		rows = slice(zone_starts[zone],zone_ends[last])
+		keys = np.repeat(np.arange(zone,last+1),zone_counts[zone:last+1])*512.0 + columns['keys'][rows]
+		order = np.argsort(keys,kind='mergesort')
+		ra = columns['keys'][rows][order]
+		xyz = sky_to_cartesian(ra,columns['x'][rows][order])
+		columns['order'][rows] = columns['order'][rows][order]
+		columns['keys'][rows] = keys[order]
+		columns['x'][rows],columns['y'][rows],columns['z'][rows] = xyz[:,0],xyz[:,1],xyz[:,2]
+		zone = last + 1
+	csl.finish_store(temp_dir,index_dir,columns,meta)
+
+def load_zone_index(store_dir,RA,Dec,chunk_size=None):
+	'''Opens the zone_index saved in a catalogue store, building and saving it first if
+	it isn't there or doesn't belong to this store. Stores are keyed on the contents
+	of the original table, so a changed table never gets an old index. With no
+	store_dir, the index is just built in memory. With chunk_size, the index is built
+	chunk_size rows at a time'''
+	if store_dir is None:
+		return zone_index(build_zone_index(RA,Dec))
+	index_dir = os.path.join(store_dir,'zone_index')
+	columns,meta = csl.load_store(index_dir)
+	if columns is not None:
+		if meta.get('version')==zone_version and meta.get('zone_height')==zone_height and meta.get('entries')==len(RA):
+			return zone_index(columns)
+	meta = {'version':zone_version,'zone_height':zone_height,'entries':len(RA)}
+	if chunk_size:
+		save_zone_index(index_dir,RA,Dec,meta,chunk_size)
+	else:
+		csl.save_store(index_dir,build_zone_index(RA,Dec),meta)
+	columns,meta = csl.load_store(index_dir)
+	return zone_index(columns)
+
+def get_ra_ranges(RA,Dec,separation):
+	'''Returns the RA ranges (deg) that could hold a source within separation (arcsec)
+	of each RA,Dec, as three pairs of (low,high) arrays - the main range, and the parts
+	that wrap past RA = 0 or 360. Unused ranges are empty (low > high)'''
+	radius = separation/3600.0
+	RA = np.mod(np.asarray(RA,dtype=float),360.0)
+	Dec = np.asarray(Dec,dtype=float)
+	##The widest a circle gets in RA, padded so floating point noise doesn't
+	##lose pairs. Anything touching a pole needs the full RA range
+	near_pole = np.abs(Dec) + radius >= 89.999
+	cos_dec = np.cos(np.minimum(np.abs(Dec) + radius,89.999)*dr)
+	width = np.degrees(np.arcsin(np.clip(np.sin(radius*dr)/cos_dec,0.0,1.0)))*(1+1e-6) + 1e-9
+	full = near_pole | (width>=180.0)
+	low,high = RA - width,RA + width
+	low[full],high[full] = -1.0,361.0
+	empty = np.ones(len(RA))
+	wrap_low = np.where((low<0) & ~full,low + 360.0,empty*361.0),np.where((low<0) & ~full,360.0,-1.0*empty)
+	wrap_high = np.where((high>=360) & ~full,0.0,empty*361.0),np.where((high>=360) & ~full,high - 360.0,-1.0*empty)
+	return [(low,high),wrap_low,wrap_high]
+
+def match_zones(RA1,Dec1,index2,separation,chunk_size=None):
+	'''Does the same as match_sky, but searches a zone_index of catalogue 2, so catalogue 2
+	never needs a KD-tree building. Catalogue 1 is searched chunk_size rows at a time
+	if given, so memory use doesn't grow with the size of catalogue 1'''
+	chord = arcsec_to_chord(separation)*(1+1e-9)
+	radius = separation/3600.0
+	all_ind1,all_ind2,all_seps = [],[],[]
+	if chunk_size:
+		chunks = get_chunks(len(RA1),chunk_size)
+	else:
+		chunks = [(0,len(RA1))]
+	for start,stop in chunks:
+		ra1 = np.asarray(RA1[start:stop],dtype=float)
+		dec1 = np.asarray(Dec1[start:stop],dtype=float)
+		xyz1 = sky_to_cartesian(ra1,dec1)
+		low_zone = get_zones(dec1 - radius,index2.num_zones)
+		high_zone = get_zones(dec1 + radius,index2.num_zones)
+		ranges = get_ra_ranges(ra1,dec1,separation)
+		##Find the rows of catalogue 2 in every RA range of every zone each source could match in
+		starts,stops,sources = [],[],[]
+		for step in xrange(int((high_zone - low_zone).max()) + 1 if len(ra1) else 0):
+			zone = low_zone + step
+			in_zone = zone<=high_zone
+			for low,high in ranges:
+				use = in_zone & (low<=high)
+				starts.append(np.searchsorted(index2.keys,zone[use]*512.0 + low[use],side='left'))
+				stops.append(np.searchsorted(index2.keys,zone[use]*512.0 + high[use],side='right'))
+				sources.append(np.where(use)[0])
+		if len(starts)==0: continue
+		starts,stops,sources = np.concatenate(starts),np.concatenate(stops),np.concatenate(sources)
+		counts = stops - starts
+		##Expand the ranges into every candidate pair
+		ind1 = np.repeat(sources,counts)
+		ind2 = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,counts) + np.repeat(starts,counts)
+		chords = np.sqrt((xyz1[ind1,0] - index2.x[ind2])**2 + (xyz1[ind1,1] - index2.y[ind2])**2 + (xyz1[ind1,2] - index2.z[ind2])**2)
+		close = chords<=chord
+		seps = chord_to_arcsec(chords[close])
+		keep = seps<=float(separation)
+		all_ind1.append(ind1[close][keep] + start)
+		all_ind2.append(np.asarray(index2.order[ind2[close][keep]]))
+		all_seps.append(seps[keep])
+	if len(all_ind1)==0:
+		return np.zeros(0,dtype=int),np.zeros(0,dtype=int),np.zeros(0)
+	ind1,ind2,seps = np.concatenate(all_ind1),np.concatenate(all_ind2),np.concatenate(all_seps)
+	order = np.lexsort((ind2,seps,ind1))
+	return ind1[order],ind2[order],seps[order]
+
+##Positions used by match_tile. These are set by match_sky_tiled before the
+##process pool is started, so the workers inherit them rather than having
+##them pickled for every tile
+tile_positions = {}
+
+def get_dec_strips(Dec,num_strips):
+	'''Splits the sky into num_strips declination strips, each holding roughly
+	the same number of the sources in Dec. Returns the strip edges in deg'''
+	edges = np.percentile(np.asarray(Dec),np.linspace(0,100,num_strips+1))
+	edges[0] = -90.0
+	edges[-1] = 90.0
+	return edges
+
+def match_tile(tile):
+	'''Matches the catalogue 1 sources that lie in one declination strip to all
+	catalogue 2 sources within the strip plus a margin of the matching radius.
+	Each catalogue 1 source only lies in one strip, so no pair is ever found twice'''
+	dec_low,dec_high,last = tile
+	RA1,Dec1,RA2,Dec2,separation = [tile_positions[key] for key in ['RA1','Dec1','RA2','Dec2','separation']]
+	Dec1 = np.asarray(Dec1)
+	Dec2 = np.asarray(Dec2)
+	if last:
+		ind1 = np.where((Dec1>=dec_low) & (Dec1<=dec_high))[0]
+	else:
+		ind1 = np.where((Dec1>=dec_low) & (Dec1<dec_high))[0]
+	##Any pair within the separation can't differ by more than the separation in Dec
+	margin = separation/3600.0
+	ind2 = np.where((Dec2>=dec_low-margin) & (Dec2<=dec_high+margin))[0]
+	if len(ind1)==0 or len(ind2)==0:
+		return np.zeros(0,dtype=int),np.zeros(0,dtype=int),np.zeros(0)
+	index1 = sky_index(np.asarray(RA1)[ind1],Dec1[ind1])
+	index2 = sky_index(np.asarray(RA2)[ind2],Dec2[ind2])
+	tile_ind1,tile_ind2,seps = match_sky(index1,index2,separation)
+	return ind1[tile_ind1],ind2[tile_ind2],seps
+
+def match_sky_tiled(RA1,Dec1,RA2,Dec2,separation,workers,tiles_per_worker=4):
+	'''Does the same as match_sky, but splits the sky into declination strips and
+	matches each strip in a pool of workers processes. The pairs from all strips
+	are merged and sorted in the same way as match_sky, so the output is identical'''
+	tile_positions.update({'RA1':RA1,'Dec1':Dec1,'RA2':RA2,'Dec2':Dec2,'separation':float(separation)})
+	edges = get_dec_strips(Dec1,workers*tiles_per_worker)
+	tiles = [(edges[i],edges[i+1],i==len(edges)-2) for i in xrange(len(edges)-1)]
+	pool = Pool(workers)
+	results = pool.map(match_tile,tiles,chunksize=1)
+	pool.close()
+	pool.join()
+	tile_positions.clear()
+
+	ind1 = np.concatenate([result[0] for result in results])
+	ind2 = np.concatenate([result[1] for result in results])
+	seps = np.concatenate([result[2] for result in results])
+	order = np.lexsort((ind2,seps,ind1))
+	return ind1[order],ind2[order],seps[order]
+
+##GROUPING FUNCTIONS+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+def union_find(num_nodes,nodes1,nodes2):
+	'''Finds the connected components of a graph of num_nodes nodes, where nodes1[i] is linked
+	to nodes2[i]. Every step is done on whole arrays: each link hooks the root of its larger
+	node on to the root of its smaller one, then every node is pointed straight at its root
+	(path compression). Links inside a component are dropped as they are found, so each
+	round works on fewer links. Returns the root of every node, which is the smallest
+	node in its component'''
+	parent = np.arange(num_nodes)
+	nodes1 = np.asarray(nodes1)
+	nodes2 = np.asarray(nodes2)
+	while len(nodes1):
+		root1,root2 = parent[nodes1],parent[nodes2]
+		split = root1!=root2
+		nodes1,nodes2,root1,root2 = nodes1[split],nodes2[split],root1[split],root2[split]
+		if len(nodes1)==0: break
+		low,high = np.minimum(root1,root2),np.maximum(root1,root2)
+		##With repeated indexes the last assignment wins, so sorting by low
+		##in reverse hooks each root on to the smallest root it is linked to
+		order = np.argsort(low,kind='mergesort')[::-1]
+		parent[high[order]] = low[order]
+		while True:
+			grand_parent = parent[parent]
+			if (grand_parent==parent).all(): break
+			parent = grand_parent
+	return parent
+
+def find_groups(links,entries1,entries2):
+	'''Links sources across all catalogues into friends-of-friends groups through their
+	matched pairs. links is a list of (ind1,ind2) row indexes, one per catalogue matched to
+	catalogue 1, and entries1 and entries2 the number of rows in each catalogue. Returns the
+	catalogue number (0 for catalogue 1), row, group ID and group size of every source with at
+	least one match. Group IDs are numbered in order of their first catalogue 1 source. The groups
+	are only written out for information; calculate_bayes.py does not use them'''
+	offsets = np.cumsum([entries1] + list(entries2))
+	nodes1 = np.concatenate([np.asarray(ind1) for ind1,ind2 in links] + [np.zeros(0,dtype=int)])
+	nodes2 = np.concatenate([np.asarray(ind2) + offset for (ind1,ind2),offset in zip(links,offsets[:-1])] + [np.zeros(0,dtype=int)])
+	##Only sources with a match are part of a group, so renumber just those
+	nodes,inverse = np.unique(np.concatenate((nodes1,nodes2)),return_inverse=True)
+	roots = union_find(len(nodes),inverse[:len(nodes1)],inverse[len(nodes1):])
+	roots,group_ids = np.unique(roots,return_inverse=True)
+	group_sizes = np.bincount(group_ids)[group_ids]
+	cats = np.searchsorted(offsets,nodes,side='right')
+	rows = nodes - np.concatenate(([0],offsets))[cats]
+	return cats,rows,group_ids,group_sizes
+
+##COMPACT PAIR FUNCTIONS++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+def save_pairs(pairs_dir,ind1,ind2,seps,meta,nus1=None,nus2=None):
+	'''Writes the matched pairs as just the row index into each normalised catalogue store and
+	the separation (arcsec). meta must name the two stores, their details and prefixes, and the
+	scaled source densities nu_1 and nu_2, so the matched table can be read by pairs_table.
+	nus1 and nus2 are the local densities of each matched source, if calculated'''
+	columns = {'ind1':np.asarray(ind1,dtype=np.int64),'ind2':np.asarray(ind2,dtype=np.int64),'Separation':np.asarray(seps,dtype=float)}
+	if nus1 is not None:
+		columns['nu1'] = np.asarray(nus1,dtype=float)
+		columns['nu2'] = np.asarray(nus2,dtype=float)
+	csl.save_store(pairs_dir,columns,meta)
+
+def matched_columns(details,prefix):
+	'''Returns the (name,normalised column,mask column) of every column make_table makes from
+	the normalised columns, in order. The mask column is None for columns without a mask'''
+	freq = details[5]
+	freqs = details[13::3]
+	columns = [('%s_name' %prefix,'name',None),('%s_RAJ2000' %prefix,'RAJ2000',None),('%s_e_RAJ2000' %prefix,'e_RAJ2000',None),
+		('%s_DEJ2000' %prefix,'DEJ2000',None),('%s_e_DEJ2000' %prefix,'e_DEJ2000',None),('%s_S%d' %(prefix,float(freq)),'S',None),
+		('%s_e_S%d' %(prefix,float(freq)),'e_S',None),('%s_MajAxis' %prefix,'MajAxis',None),('%s_MinAxis' %prefix,'MinAxis',None),
+		('%s_PA' %prefix,'PA',None),('%s_flag' %prefix,'flag','flag_mask'),('%s_FieldID' %prefix,'FieldID','FieldID_mask')]
+	for i in xrange(len(freqs)):
+		columns.append(('%s_Flux_%.1f' %(prefix,float(freqs[i])),'Flux_%d' %i,None))
+		columns.append(('%s_Flux_%.1f_err' %(prefix,float(freqs[i])),'Flux_%d_err' %i,None))
+	return columns
+
+class pairs_table:
+	'''The matched table written by save_pairs, with the same columns as a matched_*.fits
+	table. Nothing is joined up front - each column is made when asked for, by indexing the
+	memory-mapped normalised catalogue column with ind1 or ind2, and kept once made.
+	Anything other than a column name (e.g. a slice) returns a pairs_slice, which makes
+	columns for just those rows. Has the same header and byte counts as a fits_table'''
+	def __init__(self,name,pairs_dir):
+		self.name = name
+		self.pairs,meta = csl.load_store(pairs_dir)
+		self.header = {'nu_1':meta['nu_1'],'nu_2':meta['nu_2']}
+		##Where each matched column comes from - the pair column, and the normalised
+		##column and mask it indexes - in the order make_matched_table puts them
+		self.sources = {}
+		self.names = []
+		for num in ['1','2']:
+			columns,store_meta = csl.load_store(meta['store%s' %num])
+			if columns is None:
+				sys.exit('The normalised catalogue %s needed by %s is no longer in the cache - rerun cross_match.py' %(meta['store%s' %num],pairs_dir))
+			for col_name,store_name,mask_name in matched_columns(meta['details%s' %num],meta['prefix%s' %num]):
+				mask = None
+				if mask_name is not None: mask = columns[mask_name]
+				self.sources[col_name] = ('ind%s' %num,columns[store_name],mask)
+				self.names.append(col_name)
+		pair_names = [('Separation','Separation')]
+		if 'nu1' in self.pairs:
+			pair_names += [('%s_nu' %meta['prefix1'],'nu1'),('%s_nu' %meta['prefix2'],'nu2')]
+		for col_name,pair_name in pair_names:
+			self.sources[col_name] = (pair_name,None,None)
+			self.names.append(col_name)
+		self.rows = len(self.pairs['ind1'])
+		self.shape = (self.rows,)
+		self.total_bytes = sum([self.column_bytes(col_name,self.rows) for col_name in self.names])
+		self.bytes_used = 0
+		self.columns = {}
+
+	def __len__(self):
+		return self.rows
+
+	def __getitem__(self,key):
+		if isinstance(key,basestring):
+			return self.column(key)
+		return pairs_slice(self,key)
+
+	def column_bytes(self,col_name,rows):
+		'''The number of bytes a column takes up over rows rows'''
+		pair_name,column,mask = self.sources[col_name]
+		if column is None: column = self.pairs[pair_name]
+		return column.dtype.itemsize*rows
+
+	def make_column(self,col_name,key):
+		'''Makes the rows key of a column from the stores'''
+		pair_name,column,mask = self.sources[col_name]
+		inds = np.asarray(self.pairs[pair_name][key])
+		if column is None: return inds
+		values = np.asarray(column[inds])
+		##Masked entries are filled as astropy fills them, and FITS drops trailing
+		##spaces from strings, so do the same here
+		if mask is not None: values = np.where(np.asarray(mask[inds]),'--',values)
+		if values.dtype.kind in 'SU': values = np.char.rstrip(values)
+		return values
+
+	def column(self,col_name):
+		'''Makes a single column, or returns it if already made'''
+		if col_name not in self.columns:
+			self.columns[col_name] = self.make_column(col_name,slice(None))
+			self.bytes_used += self.column_bytes(col_name,self.rows)
+		return self.columns[col_name]
+
+class pairs_slice:
+	'''Some of the rows of a pairs_table, e.g. one chunk. Columns are made for just
+	those rows, and kept only as long as the slice is'''
+	def __init__(self,table,key):
+		self.table = table
+		self.key = key
+		self.rows = len(np.arange(table.rows)[key])
+		self.shape = (self.rows,)
+		self.columns = {}
+
+	def __len__(self):
+		return self.rows
+
+	def __getitem__(self,col_name):
+		if col_name not in self.columns:
+			self.columns[col_name] = self.table.make_column(col_name,self.key)
+			self.table.bytes_used += self.table.column_bytes(col_name,self.rows)
+		return self.columns[col_name]
+
+##ADAPTIVE RADIUS FUNCTIONS+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+def position_sigma(e_RA,e_Dec,blank=-100000.0):
+	'''Returns the positional error of each source in arcsec, adding the RA and Dec errors
+	(in deg) in quadrature. Missing, zero or negative errors are replaced by the average of
+	the good errors in the same catalogue, so those sources are cut on a typical error. If
+	no source has a good error, the sigma is infinite so the source is never cut'''
+	sigmas = []
+	for error in [e_RA,e_Dec]:
+		error = np.array(error,dtype=float)
+		good = (error>0) & (error!=blank) & np.isfinite(error)
+		if good.any():
+			error[~good] = error[good].mean()
+		else:
+			error[:] = np.inf
+		sigmas.append(error)
+	return np.sqrt(sigmas[0]**2 + sigmas[1]**2)*3600.0
+
+def adaptive_keep(ind1,ind2,seps,radius,sigma1=None,sigma2=None,num_sigma=None):
+	'''Returns a boolean array of the pairs found by match_sky to keep. A pair is kept if it
+	lies within radius (arcsec) and, if num_sigma is given, within num_sigma times the combined
+	positional error of the two sources - the separation beyond which the Bayes factor of
+	Budavari & Szalay (2008) makes the posterior effectively zero'''
+	keep = seps<=float(radius)
+	if num_sigma:
+		keep &= seps<=float(num_sigma)*np.sqrt(sigma1[ind1]**2 + sigma2[ind2]**2)
+	return keep
+
+def count_combinations(counts):
+	'''Takes an (N,num_cats) array of the number of matches each of N primary sources has in each
+	catalogue, and returns the total number of combinations calculate_bayes.py has to test'''
+	counts = np.asarray(counts,dtype=float)
+	grouped = counts.sum(axis=1)>0
+	return np.prod(np.maximum(counts[grouped],1),axis=1).sum()
+
+def add_local_density(match_table,prefix1,nus1,prefix2,nus2):
+	'''Appends the local scaled source density of each matched source as the last
+	two columns, after the separation'''
+	for prefix,nus in [(prefix1,nus1),(prefix2,nus2)]:
+		match_table.add_column(Column(name='%s_nu' %prefix,data=nus,description='Local scaled source density',dtype=float))
+
+def make_matched_table(matched1,matched2,seps):
+	'''Joins two simple tables row by row, where matched1 and matched2 contain the rows
+	matched by match_sky, and appends the separation column in the same way stilts
+	tmatch2 join=1and2 fixcols=all does'''
+	match_table = hstack([matched1,matched2],join_type='exact',metadata_conflicts='silent')
+	match_table.meta = {}
+	t_seps = Column(name='Separation',data=seps,description='Distance between matched points',unit='arcsec',dtype=float)
+	match_table.add_column(t_seps)
+	return match_table
@@ -0,0 +1,408 @@
+#!/usr/bin/python
+import numpy as np
+import json
+import os
+import shutil
+import sys
+import catalogue_store_lib as csl
+
+##Bump this if the layout of a group store ever changes
+store_version = '1'
+
+##A group store holds the output of calculate_bayes.py as one .npy file per column,
+##readable with csl.load_store. For G groups, N sources and M combinations:
+##  group_sources, group_combinations - (G+1) offsets of each group into the source
+##                                      and combination columns
+##  cat                               - (N) catalogue number of each source (into meta['cats'])
+##  ra,rerr,dec,derr,major,minor,PA   - (N) floats of each source
+##  flux_<i>,ferr_<i>                 - (N) flux and error at the i-th frequency of the
+##                                      source's catalogue (-100000.0 past the last)
+##  name,flag,ID                      - strings of each source, stored as all the characters
+##                                      in <column>_chars with (N+1) <column>_offsets
+##  combination_<k>                   - (M) source chosen from catalogue k in each combination,
+##                                      as a row of the group (-1 if not in the combination)
+##  bayes,prior,posterior             - (M) floats of each combination
+source_floats = ['ra','rerr','dec','derr','major','minor','PA']
+source_strings = ['name','flag','ID']
+score_floats = ['bayes','prior','posterior']
+
+##Entry used for any missing piece of information in the text format
+null = '-100000.0'
+
+def encode_strings(strings):
+	'''Turns a list of strings into an array of all their characters, and the (len+1) offsets
+	that each string starts at'''
+	offsets = np.zeros(len(strings)+1,dtype=np.int64)
+	offsets[1:] = np.cumsum([len(string) for string in strings])
+	chars = np.fromstring(''.join(strings),dtype=np.uint8)
+	return chars,offsets
+
+def decode_strings(chars,offsets,start,end):
+	'''Returns strings start to end of a column stored by encode_strings'''
+	block = np.asarray(chars[offsets[start]:offsets[end]]).tostring()
+	base = offsets[start]
+	return [block[offsets[ind]-base:offsets[ind+1]-base] for ind in xrange(start,end)]
+
+def array_columns(sizes,sources,combinations):
+	'''Makes the columns of a group store for some groups, from sources held as arrays. sizes
+	is how many sources each group has, and sources a dict of arrays over every source of
+	every group in order: 'cat' (the catalogue number), each of source_floats and
+	source_strings, and 'flux' and 'ferr' as (sources x frequencies) blocks, with -100000.0
+	past the last frequency of each catalogue. combinations is as for make_columns'''
+	columns = {}
+	columns['group_sources'] = np.concatenate(([0],np.cumsum(sizes))).astype(np.int64)
+	columns['cat'] = np.asarray(sources['cat'],dtype=np.int16)
+	for name in source_floats:
+		columns[name] = np.asarray(sources[name],dtype=float)
+	for name in source_strings:
+		columns['%s_chars' %name],columns['%s_offsets' %name] = encode_strings(list(sources[name]))
+	for name in ['flux','ferr']:
+		for freq in xrange(sources[name].shape[1]):
+			columns['%s_%d' %(name,freq)] = np.asarray(sources[name][:,freq],dtype=float)
+	chosen,bayes_factors,priors,posteriors = combinations
+	for cat in xrange(chosen.shape[1]):
+		columns['combination_%d' %cat] = np.asarray(chosen[:,cat],dtype=np.int32)
+	for name,values in zip(score_floats,[bayes_factors,priors,posteriors]):
+		columns[name] = np.asarray(values,dtype=float)
+	return columns
+
+def make_columns(cats,freqs,groups,combinations):
+	'''Makes the columns of a group store for some groups. groups is a list of groups, each
+	a list of sources, where a source is a list of the 14 text entries calculate_bayes.py
+	writes for it (cat,name,ra,rerr,dec,derr,freq,flux,ferr,major,minor,PA,flag,ID), with
+	lists of freqs, fluxes and errors for catalogues with more than one frequency.
+	combinations holds an array (combinations x catalogues) of the row in its group of
+	every source in every combination (-1 where missing), followed by arrays of the bayes
+	factors, priors and posteriors. The combinations of each group must follow on from
+	those of the group before'''
+	cat_inds = dict([(cat,ind) for ind,cat in enumerate(cats)])
+	max_freqs = max([len(cat_freqs) for cat_freqs in freqs])
+	sources = [source for group in groups for source in group]
+	arrays = {}
+	arrays['cat'] = [cat_inds[source[0]] for source in sources]
+	for name,ind in zip(source_floats,[2,3,4,5,9,10,11]):
+		arrays[name] = [float(source[ind]) for source in sources]
+	for name,ind in zip(source_strings,[1,12,13]):
+		arrays[name] = [source[ind] for source in sources]
+	for name,ind in [('flux',7),('ferr',8)]:
+		arrays[name] = np.zeros((len(sources),max_freqs)) + float(null)
+		for row,source in enumerate(sources):
+			values = source[ind] if type(source[ind])==list else [source[ind]]
+			arrays[name][row,:len(values)] = [float(value) for value in values]
+	return array_columns([len(group) for group in groups],arrays,combinations)
+
+def set_group_combinations(columns,counts):
+	'''Adds the (G+1) offsets of the combinations of each group, from how many each has'''
+	columns['group_combinations'] = np.concatenate(([0],np.cumsum(counts))).astype(np.int64)
+
+def is_offsets(name):
+	'''True for the columns that hold offsets into other columns, which have one
+	more entry than the rows they index'''
+	return name.startswith('group_') or name.endswith('_offsets')
+
+def join_columns(all_columns):
+	'''Joins a list of sets of columns (from make_columns) into one set, in order'''
+	columns = {}
+	for name in all_columns[0].keys():
+		if is_offsets(name):
+			pieces,last = [np.zeros(1,dtype=np.int64)],0
+			for cols in all_columns:
+				pieces.append(cols[name][1:] + last)
+				last += cols[name][-1]
+			columns[name] = np.concatenate(pieces)
+		else:
+			columns[name] = np.concatenate([cols[name] for cols in all_columns])
+	return columns
+
+class group_writer:
+	'''Writes a new group store a batch of groups at a time (as made by make_columns).
+	Each column is appended to a raw file as it goes, so only one batch is ever held in
+	memory, and every raw file is turned into a memory-mappable .npy by finish. Nothing
+	is in store_dir until finish is called. kind is 'groups', or 'score_cache' for a
+	score_cache'''
+	def __init__(self,store_dir,cats,freqs,kind='groups'):
+		self.store_dir = store_dir
+		self.temp_dir = '%s.tmp%d' %(store_dir,os.getpid())
+		if os.path.exists(self.temp_dir): shutil.rmtree(self.temp_dir)
+		os.makedirs(self.temp_dir)
+		self.meta = {'store_version':store_version,'kind':kind,'cats':list(cats),'freqs':[list(cat_freqs) for cat_freqs in freqs]}
+		self.files = {}
+		self.dtypes = {}
+		self.lengths = {}
+		##The offsets columns hold one more entry than the rows they index, so each
+		##batch carries on from the last offset written
+		self.last_offsets = {}
+
+	def add_groups(self,columns):
+		for name,column in columns.items():
+			column = np.asarray(column)
+			if name not in self.files:
+				self.files[name] = open(os.path.join(self.temp_dir,'%s.raw' %name),'wb')
+				self.dtypes[name] = column.dtype
+				self.lengths[name] = 0
+				if is_offsets(name):
+					self.last_offsets[name] = 0
+					self.files[name].write(np.zeros(1,dtype=column.dtype).tostring())
+					self.lengths[name] = 1
+			if name in self.last_offsets:
+				column = column[1:] + self.last_offsets[name]
+				if len(column): self.last_offsets[name] = column[-1]
+			self.files[name].write(column.astype(self.dtypes[name]).tostring())
+			self.lengths[name] += len(column)
+
+	def finish(self):
+		'''Turns every raw column into a .npy file, writes the meta data, and renames the store
+		into place, so a half written store can never be read back'''
+		for name,outfile in self.files.items():
+			outfile.close()
+			raw_name = os.path.join(self.temp_dir,'%s.raw' %name)
+			with open(os.path.join(self.temp_dir,'%s.npy' %name),'wb') as npy_file:
+				header = {'descr':np.lib.format.dtype_to_descr(self.dtypes[name]),'fortran_order':False,'shape':(self.lengths[name],)}
+				np.lib.format.write_array_header_1_0(npy_file,header)
+				with open(raw_name,'rb') as raw_file:
+					shutil.copyfileobj(raw_file,npy_file)
+			os.remove(raw_name)
+		meta = dict(self.meta)
+		meta['groups'] = self.lengths.get('group_sources',self.lengths.get('group_combinations',1)) - 1
+		meta['sources'] = self.lengths.get('cat',0)
+		meta['combinations'] = self.lengths.get('bayes',0)
+		meta['columns'] = sorted(self.files.keys())
+		with open(os.path.join(self.temp_dir,'meta.json'),'w') as outfile:
+			json.dump(meta,outfile)
+		if os.path.exists(self.store_dir): shutil.rmtree(self.store_dir)
+		os.rename(self.temp_dir,self.store_dir)
+
+##A score cache holds the scores of every group of a run of calculate_bayes.py --cache,
+##so a later run can reuse them for any group that hasn't changed. It is written with a
+##group_writer (kind='score_cache'), with a row per group of
+##  key                  - the key calculate_bayes.py made from everything the scores depend on
+##  truncated, seconds   - whether the group was truncated, and about how long it took to score
+##and the combination columns of a group store (group_combinations, combination_<k>, bayes,
+##prior, posterior), with combination_<k> for the k-th catalogue in meta['cats']
+def cache_columns(keys,counts,truncated,seconds,combinations):
+	'''Makes the columns of a score cache for some groups. counts is how many combinations
+	each group has, and combinations is as for make_columns'''
+	columns = {'key':np.asarray(keys,dtype='S40'),'truncated':np.asarray(truncated,dtype=bool),'seconds':np.asarray(seconds,dtype=float)}
+	chosen,bayes_factors,priors,posteriors = combinations
+	for cat in xrange(chosen.shape[1]):
+		columns['combination_%d' %cat] = np.asarray(chosen[:,cat],dtype=np.int32)
+	for name,values in zip(score_floats,[bayes_factors,priors,posteriors]):
+		columns[name] = np.asarray(values,dtype=float)
+	set_group_combinations(columns,counts)
+	return columns
+
+class score_cache:
+	'''The scores from a score cache, for a run matching the catalogues cats. If cache_dir
+	doesn't exist yet, the cache is empty'''
+	def __init__(self,cache_dir,cats):
+		self.cats = list(cats)
+		self.keys = np.array([],dtype='S40')
+		columns,meta = csl.load_store(cache_dir)
+		if columns is not None:
+			if meta.get('store_version')!=store_version or meta.get('kind')!='score_cache':
+				sys.exit('%s is not a score cache this version can read' %cache_dir)
+			self.columns = columns
+			self.keys = np.asarray(columns['key'])
+			self.group_combinations = np.asarray(columns['group_combinations'])
+			##Where each catalogue of this run was in the cached run (-1 if it wasn't).
+			##The key of a group covers its catalogues, so a group found in the cache only
+			##has sources from catalogues in both
+			cache_cats = [str(cat) for cat in meta['cats']]
+			self.cache_inds = [cache_cats.index(cat) if cat in cache_cats else -1 for cat in self.cats]
+		self.order = np.argsort(self.keys)
+		self.sorted_keys = self.keys[self.order]
+
+	def __len__(self):
+		return len(self.keys)
+
+	def find(self,keys):
+		'''Returns the group in the cache with each of keys, or -1 where there isn't one'''
+		keys = np.asarray(keys,dtype='S40')
+		if len(self)==0: return np.zeros(len(keys),dtype=int) - 1
+		places = np.minimum(np.searchsorted(self.sorted_keys,keys),len(self)-1)
+		return np.where(self.sorted_keys[places]==keys,self.order[places],-1)
+
+	def scores(self,groups):
+		'''Returns how many combinations each of groups (in the cache) has, and all their
+		combinations in order, as for make_columns, along with whether each group was
+		truncated and how long it took to score'''
+		starts,ends = self.group_combinations[groups],self.group_combinations[np.asarray(groups)+1]
+		counts = ends - starts
+		inds = np.repeat(starts - (np.cumsum(counts) - counts),counts) + np.arange(counts.sum())
+		chosen = np.zeros((len(inds),len(self.cats)),dtype=np.int32) - 1
+		for cat,cache_ind in enumerate(self.cache_inds):
+			if cache_ind>=0: chosen[:,cat] = self.columns['combination_%d' %cache_ind][inds]
+		bayes_factors,priors,posteriors = [np.asarray(self.columns[name])[inds] for name in score_floats]
+		truncated = np.asarray(self.columns['truncated'])[groups]
+		seconds = np.asarray(self.columns['seconds'])[groups]
+		return counts,(chosen,bayes_factors,priors,posteriors),truncated,seconds
+
+def is_store(name):
+	'''True if name is a group store rather than a text file'''
+	return os.path.isdir(name) and os.path.exists(os.path.join(name,'meta.json'))
+
+class group_store:
+	'''A group store opened for reading. Every column is memory-mapped, so only the
+	groups that are used are ever read from disk'''
+	def __init__(self,store_dir):
+		columns,self.meta = csl.load_store(store_dir)
+		if self.meta is None or self.meta.get('store_version')!=store_version or self.meta.get('kind','groups')!='groups':
+			sys.exit('%s is not a group store this version can read' %store_dir)
+		##Plain array views of the memory maps are still only read as used, but
+		##are much quicker to index one value at a time
+		self.columns = dict([(name,np.asarray(column)) for name,column in columns.items()])
+		##json gives back unicode, which would turn all the text unicode
+		self.cats = [str(cat) for cat in self.meta['cats']]
+		self.freqs = [[str(freq) for freq in cat_freqs] for cat_freqs in self.meta['freqs']]
+		self.group_sources = np.asarray(self.columns['group_sources'])
+		self.group_combinations = np.asarray(self.columns['group_combinations'])
+
+	def __len__(self):
+		return len(self.group_sources) - 1
+
+	def group_text(self,group):
+		'''Returns the text calculate_bayes.py writes for one group'''
+		return group_text(self.columns,self.cats,self.freqs,self.group_sources[group],self.group_sources[group+1],
+			self.group_combinations[group],self.group_combinations[group+1])
+
+def source_entries(columns,cats,freqs,start,end):
+	'''Returns the text entries of sources start to end, as for make_columns'''
+	names,flags,IDs = [decode_strings(columns['%s_chars' %name],columns['%s_offsets' %name],start,end) for name in source_strings]
+	floats = [[str(value) for value in columns[name][start:end]] for name in source_floats]
+	cat_nums = columns['cat'][start:end]
+	fluxs = {}
+	for freq in xrange(max([len(cat_freqs) for cat_freqs in freqs])):
+		for name in ['flux','ferr']:
+			fluxs[name,freq] = [str(value) for value in columns['%s_%d' %(name,freq)][start:end]]
+	entries = []
+	for row in xrange(end-start):
+		cat = cat_nums[row]
+		ra,rerr,dec,derr,major,minor,PA = [values[row] for values in floats]
+		if len(freqs[cat])==1:
+			freq,flux,ferr = freqs[cat][0],fluxs['flux',0][row],fluxs['ferr',0][row]
+		else:
+			freq = list(freqs[cat])
+			flux = [fluxs['flux',ind][row] for ind in xrange(len(freq))]
+			ferr = [fluxs['ferr',ind][row] for ind in xrange(len(freq))]
+		entries.append([cats[cat],names[row],ra,rerr,dec,derr,freq,flux,ferr,major,minor,PA,flags[row],IDs[row]])
+	return entries
+
+def group_text(columns,cats,freqs,source_start,source_end,comb_start,comb_end):
+	'''Returns the text calculate_bayes.py writes for one group, from the sources and
+	combinations in the given ranges of a set of group store columns'''
+	entries = source_entries(columns,cats,freqs,source_start,source_end)
+	text = ['START_GROUP\n']
+	##Write all information for each source in an indivudual line for each group
+	##Account for catalogues with more than one frequency
+	for entry in entries:
+		if type(entry[6])!=list:
+			text.append("%s %s %s %s %s %s %s %s %s %s %s %s %s %s\n" %tuple(entry))
+		else:
+			flux_str = ''.join(["%s %s %s " %values for values in zip(entry[6],entry[7],entry[8])])
+			text.append("%s %s %s %s %s %s %s%s %s %s %s %s\n" %tuple(entry[:6]+[flux_str]+entry[9:]))
+
+	text.append('START_COMP\n')
+	##The positions and errors of each combination are written as python floats, and the
+	##prior too, as calculate_bayes.py always has
+	chosen = [columns['combination_%d' %cat][comb_start:comb_end] for cat in xrange(len(cats))]
+	positions = [[str(float(entry[ind])) for ind in xrange(2,6)] for entry in entries]
+	scores = [columns[name][comb_start:comb_end] for name in score_floats]
+	for comb in xrange(comb_end-comb_start):
+		match_str = ''
+		for cat in xrange(len(cats)):
+			row = chosen[cat][comb]
+			if row>=0:
+				entry = entries[row]
+				if type(entry[6])!=list:
+					match_str += "%s %s %s %s %s %s %s %s %s %s %s %s %s %s " %tuple(entry[:2]+positions[row]+entry[6:])
+				else:
+					flux_str = ''.join(["%s %s %s " %values for values in zip(entry[6],entry[7],entry[8])])
+					match_str += "%s %s %s %s %s %s %s%s %s %s %s %s " %tuple(entry[:2]+positions[row]+[flux_str]+entry[9:])
+			else:
+				##If a catalogue isn't in this combination, write a null for every entry
+				match_str += '%s ' %null * (14 + 3*(len(freqs[cat])-1))
+		bayes,prior,posterior = scores[0][comb],scores[1][comb],scores[2][comb]
+		match_str += '%s %s %s\n' %(str(bayes),str(float(prior)),str(posterior))
+		text.append(match_str)
+	text.append('END_COMP\n')
+	text.append('END_GROUP\n')
+	return ''.join(text)
+
+def groups_text(columns,cats,freqs):
+	'''Returns the text calculate_bayes.py writes for every group in a set of columns'''
+	group_sources = columns['group_sources']
+	group_combinations = columns['group_combinations']
+	return ''.join([group_text(columns,cats,freqs,group_sources[group],group_sources[group+1],
+		group_combinations[group],group_combinations[group+1]) for group in xrange(len(group_sources)-1)])
+
+def read_text_groups(name,cats,freqs):
+	'''Reads the text output of calculate_bayes.py, yielding the columns (from make_columns)
+	of one group at a time. cats and freqs are the catalogue names and the list of frequency
+	strings of each, in the order they were matched'''
+	lengths = [14 + 3*(len(cat_freqs)-1) for cat_freqs in freqs]
+	starts = np.concatenate(([0],np.cumsum(lengths)))
+	sources,matches = [],[]
+	in_comp = False
+	for line in open(name):
+		line = line.rstrip('\n')
+		if line=='START_GROUP':
+			sources,matches = [],[]
+			in_comp = False
+		elif line=='START_COMP':
+			in_comp = True
+		elif line=='END_COMP':
+			in_comp = False
+		elif line=='END_GROUP':
+			rows = dict([((source[0],source[1]),row) for row,source in reversed(list(enumerate(sources)))])
+			chosen = np.zeros((len(matches),len(cats)),dtype=np.int32) - 1
+			for comb,match in enumerate(matches):
+				for cat in xrange(len(cats)):
+					entry = match[starts[cat]:starts[cat+1]]
+					if entry[0]!=null: chosen[comb,cat] = rows[entry[0],entry[1]]
+			scores = np.array([[float(value) for value in match[-3:]] for match in matches]).reshape(len(matches),3)
+			columns = make_columns(cats,freqs,[sources],(chosen,scores[:,0],scores[:,1],scores[:,2]))
+			set_group_combinations(columns,[len(matches)])
+			yield columns
+		elif in_comp:
+			matches.append(line.split())
+		else:
+			info = line.split()
+			##Catalogues with more than one frequency have a freq, flux and error for each
+			num_freqs = (len(info) - 11)/3
+			if num_freqs==1:
+				sources.append(info)
+			else:
+				freq_info = info[6:6+3*num_freqs]
+				sources.append(info[:6] + [freq_info[0::3],freq_info[1::3],freq_info[2::3]] + info[6+3*num_freqs:])
+
+class group_texts:
+	'''The text of every group in a group store, split up as for read_groups. Each
+	group's text is only made when it is asked for'''
+	def __init__(self,store):
+		self.store = store
+
+	def __len__(self):
+		return len(self.store)
+
+	def __getitem__(self,group):
+		if group<0: group += len(self.store)
+		if not 0<=group<len(self.store): raise IndexError('group %d is not in the store' %group)
+		text = self.store.group_text(group)[:-len('END_GROUP\n')]
+		##Splitting the text on END_GROUP leaves the newline after it on the next group
+		if group>0: text = '\n' + text
+		return text
+
+	def __iter__(self):
+		for group in xrange(len(self.store)):
+			yield self[group]
+
+def read_groups(name):
+	'''Returns the text of every group written by calculate_bayes.py, split up in the same
+	way as open(name).read().split('END_GROUP') with the empty last entry removed. name can
+	be a text file or a group store; from a store, the text is only made for each group as
+	it is used'''
+	if not is_store(name):
+		comps = open(name).read().split('END_GROUP')
+		del comps[-1]
+		return comps
+	return group_texts(group_store(name))
@@ -18,7 +18,7 @@ parser.add_option('-c', '--cat_freqs',
 	help='Enter number of frequencies in each catalogue')
 	
 parser.add_option('-i', '--input_bayes', 
-	help='Enter name of input matched bayes')
+	help='Enter name of input matched bayes (a text file or group store)')
 
 parser.add_option('-o', '--output_name', 
 	help='Enter name for output catalogue')
@@ -110,7 +110,7 @@ to_accept_accepts = []
 def make_entry(match,SI,intercept,SI_err,intercept_err,g_stats,accept_type,low_resids,chired):
 	'''Gather all of the information together in to a format that can easily be read in to create
 	the output VOTable'''
-	source = mkl.get_srcg(match)
+	source = copy.copy(match)
 	source.SI = SI
 	source.intercept = intercept
 	source.SI_err = SI_err
@@ -171,16 +171,16 @@ def single_match_test(src_all,comp,accepted_matches,accepted_inds,g_stats,num_ma
 	'''Takes a combination of sources, one from each catalogue, with positional probabilities,
 	and determines whether they are a match or not - Algorithm 2 in the write up'''
 	match = accepted_matches[0]
-	prob = float(match[-1])
+	prob = match.prob
 	
 	##calculate_resids needs a list of matches - calculate parameters
 	jstat_resids,params,bses,chi_resids = mkl.calculate_resids([match])
 
 	##Gather source information
-	src_g = mkl.get_srcg(match)
+	src_g = match
 	
 	##Play the prob trick again to work out which match has been accepted
-	match_probs = [float(m.split()[-1]) for m in matches]
+	match_probs = [m.prob for m in matches]
 	dom_num = match_probs.index(prob)+1
 	match_crit = "Combination (%d)\npossible\n%s repeated cats" %(dom_num,repeated_cats)
 	
@@ -247,27 +247,15 @@ def single_match_test(src_all,comp,accepted_matches,accepted_inds,g_stats,num_ma
 			make_rejection(comp,g_stats,'position',[0])
 
 ##Open the input text file (output from calculate_bayes.py)
-bayes_comp = open(options.input_bayes).read().split('END_GROUP')
-del bayes_comp[-1]
-
-for comp in bayes_comp:
-	##Get the information into nice usable forms, and get rid of empty/pointless
-	##entries
-	chunks = comp.split('START_COMP')
-	all_info = chunks[0].split('\n')
-	
-	##FOR SOME REASON CAN'T DO BOTH OF THESE LINES IN THE SAME FOR LOOP?!?!?!
-	for entry in all_info:   
-		if entry=='': del all_info[all_info.index(entry)]
-	for entry in all_info:
-		if 'START' in entry: del all_info[all_info.index(entry)]
-
-	matches = chunks[1].split('\n')
-	del matches[0],matches[-2:]
-	
-	##Put the information for every source in the matched group in one source_group() class
-	##(see apply_criteria_lib for source_group())
-	src_all = mkl.get_allinfo(all_info)
+##This can also be a group store written with calculate_bayes.py --store, which is
+##read straight from its columns
+bayes_comp = mkl.bayes_groups(options.input_bayes)
+
+##The information for every source in the matched group comes in one source_group() class,
+##and for every combination in a list of them (see make_table_lib for source_group())
+for group,src_all,matches in bayes_comp:
+	##The text of the group is written out with the outcome
+	comp = bayes_comp.text(group)
 	
 	##This line applies positional criteria, and tells us if a simple one catalogue repeat source, returning
 	##how many combinations are possible and statistics on them
@@ -292,7 +280,7 @@ for comp in bayes_comp:
 		num_cat = len(set([cat for cat in src_all.cats if cat!='-100000.0']))
 		
 		dom_source = mkl.spec_pos_agree(jstats,chi_reds,accepted_probs,num_cat)
-		src_g = mkl.get_srcg(accepted_matches[0])
+		src_g = accepted_matches[0]
 		##If it finds a dominant source, accept it - counts as a spectral match 
 		if dom_source!='none':
 			jstat_resids,params,bses,chi_resids = mkl.calculate_resids([accepted_matches[dom_source]])
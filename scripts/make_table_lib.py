@@ -4,6 +4,7 @@ import statsmodels.api as sm
 from statsmodels.sandbox.regression.predstd import wls_prediction_std
 from itertools import combinations
 import copy
+import group_store_lib as gsl
 
 dr = np.pi/180.0
 
@@ -262,35 +263,123 @@ def get_srcg(info):
 		src_g.prob = float(info[-1])
 	return src_g
 ##-------------------------------------------------------------------------------------------------------------
+
+def split_group(comp):
+	'''Takes the text of one group written by calculate_bayes.py, and returns the information for
+	every source in a source_group() class (see get_allinfo), and the information for every
+	combination in a list of source_group() classes (see get_srcg)'''
+	chunks = comp.split('START_COMP')
+	all_info = chunks[0].split('\n')
+	
+	##FOR SOME REASON CAN'T DO BOTH OF THESE LINES IN THE SAME FOR LOOP?!?!?!
+	for entry in all_info:   
+		if entry=='': del all_info[all_info.index(entry)]
+	for entry in all_info:
+		if 'START' in entry: del all_info[all_info.index(entry)]
+
+	matches = chunks[1].split('\n')
+	del matches[0],matches[-2:]
+	return get_allinfo(all_info),[get_srcg(match.split()) for match in matches]
+
+def store_group(store,group):
+	'''Does the same as split_group for one group of a group store (see group_store_lib),
+	reading the values straight from the store columns rather than from text'''
+	columns = store.columns
+	start,end = store.group_sources[group],store.group_sources[group+1]
+	comb_start,comb_end = store.group_combinations[group],store.group_combinations[group+1]
+	null = float(gsl.null)
+	
+	cat_nums = np.asarray(columns['cat'][start:end])
+	src_all = source_group()
+	src_all.cats = [store.cats[cat] for cat in cat_nums]
+	src_all.names,src_all.flags,src_all.IDs = [gsl.decode_strings(columns['%s_chars' %name],columns['%s_offsets' %name],start,end) for name in gsl.source_strings]
+	src_all.ras,src_all.rerrs,src_all.decs,src_all.derrs,src_all.majors,src_all.minors,src_all.PAs = [columns[name][start:end].tolist() for name in gsl.source_floats]
+	max_freqs = max([len(cat_freqs) for cat_freqs in store.freqs])
+	fluxs = np.array([columns['flux_%d' %ind][start:end] for ind in xrange(max_freqs)]).T
+	ferrs = np.array([columns['ferr_%d' %ind][start:end] for ind in xrange(max_freqs)]).T
+	for row in xrange(end-start):
+		freqs = [float(freq) for freq in store.freqs[cat_nums[row]]]
+		src_all.freqs.append(np.array(freqs))
+		src_all.fluxs.append(fluxs[row,:len(freqs)].copy())
+		src_all.ferrs.append(ferrs[row,:len(freqs)].copy())
+	
+	##Every combination has an entry for every catalogue, full of nulls if it has no source from it
+	chosen = [columns['combination_%d' %cat][comb_start:comb_end].tolist() for cat in xrange(len(store.cats))]
+	posteriors = columns['posterior'][comb_start:comb_end].tolist()
+	src_gs = []
+	for comb in xrange(comb_end-comb_start):
+		src_g = source_group()
+		for cat in xrange(len(store.cats)):
+			row = chosen[cat][comb]
+			if row>=0:
+				src_g.cats.append(src_all.cats[row])
+				src_g.names.append(src_all.names[row])
+				src_g.ras.append(src_all.ras[row])
+				src_g.rerrs.append(src_all.rerrs[row])
+				src_g.decs.append(src_all.decs[row])
+				src_g.derrs.append(src_all.derrs[row])
+				src_g.freqs.append(src_all.freqs[row].tolist())
+				src_g.fluxs.append(src_all.fluxs[row].tolist())
+				src_g.ferrs.append(src_all.ferrs[row].tolist())
+				src_g.majors.append(src_all.majors[row])
+				src_g.minors.append(src_all.minors[row])
+				src_g.PAs.append(src_all.PAs[row])
+				src_g.flags.append(src_all.flags[row])
+				src_g.IDs.append(src_all.IDs[row])
+			else:
+				num_freq = len(store.freqs[cat])
+				for values in [src_g.cats,src_g.names,src_g.flags,src_g.IDs]: values.append(gsl.null)
+				for values in [src_g.ras,src_g.rerrs,src_g.decs,src_g.derrs,src_g.majors,src_g.minors,src_g.PAs]: values.append(null)
+				for values in [src_g.freqs,src_g.fluxs,src_g.ferrs]: values.append([null]*num_freq)
+		src_g.prob = posteriors[comb]
+		src_gs.append(src_g)
+	return src_all,src_gs
+
+class bayes_groups:
+	'''The groups written by calculate_bayes.py, either as text or as a group store. Iterating
+	gives the number of each group, the source_group() of all its sources and a list of the
+	source_group() of every combination. From a group store these come straight from the
+	columns, and the text of a group is only made if asked for with text()'''
+	def __init__(self,name):
+		self.comps = gsl.read_groups(name)
+		self.store = None
+		if gsl.is_store(name): self.store = self.comps.store
+
+	def __len__(self):
+		return len(self.comps)
+
+	def text(self,group):
+		return self.comps[group]
+
+	def __iter__(self):
+		for group in xrange(len(self.comps)):
+			if self.store is None:
+				src_all,src_gs = split_group(self.comps[group])
+			else:
+				src_all,src_gs = store_group(self.store,group)
+			yield group,src_all,src_gs
+
 	
 def calculate_resids(matches):
-	'''Takes a list that includes lists of matched source information. Extracts the spectral
-	data for each match and fits a line to it. Returns a list of the residuals'''
+	'''Takes a list of source_group() classes, one for each matched combination (see get_srcg).
+	Extracts the spectral data for each match and fits a line to it. Returns a list of the residuals'''
 	jstat_resids = []
 	chi_resids = []
 	params = []
 	bses = []
-	##Don't use get_srcg() because we don't need positions, so don't
-	##need to append frequencies etc as lists within lists
-	indexes = [(14+((i-1)*3)) for i in num_freqs]
-	starts = [0]
-	for i in xrange(len(indexes)-1): starts.append(sum(indexes[:i+1]))
 	
-	for info in matches:
+	for src_g in matches:
 		freqs = []
 		fluxs = []
 		ferrs = []
 		##For each frequency in each catalogue, see if there is an flux and append if there
-		for j in xrange(len(starts)): 
-			num_freq = num_freqs[j]
-			ind = starts[j]
-			cat = info[ind]
+		for cat,cat_freqs,cat_fluxs,cat_ferrs in zip(src_g.cats,src_g.freqs,src_g.fluxs,src_g.ferrs):
 			if cat!='-100000.0':
-				for k in xrange(num_freq):
-					if info[7+ind+(3*k)]!='-100000.0':
-						freqs.append(float(info[6+ind+(3*k)]))
-						fluxs.append(float(info[7+ind+(3*k)]))
-						ferrs.append(float(info[8+ind+(3*k)])/float(info[7+ind+(3*k)]))
+				for freq,flux,ferr in zip(cat_freqs,cat_fluxs,cat_ferrs):
+					if flux!=-100000.0:
+						freqs.append(freq)
+						fluxs.append(flux)
+						ferrs.append(ferr/flux)
 					
 		log_fluxs = np.log([flux for (freq,flux) in sorted(zip(freqs,fluxs),key=lambda pair: pair[0])])
 		sorted_ferrs = np.array([ferr for (freq,ferr) in sorted(zip(freqs,ferrs),key=lambda pair: pair[0])])
@@ -716,7 +805,8 @@ class group_stats:
 def matches_retained(src_all,matches):
 	##COMPARE COMBINED RESIDS TO SING RESIDS??
 	'''Return matches that pass positional criteria, ie either
-	within closeness test of base cat OR prob > prob threshold'''
+	within closeness test of base cat OR prob > prob threshold. Each
+	match is a source_group() class (see get_srcg)'''
 	g_stats = group_stats()
 	g_stats.num_matches = len(matches)
 	
@@ -757,12 +847,9 @@ def matches_retained(src_all,matches):
 	probs_test = []
 	probs_values = []
 	for match in matches:
-		##Match_ind basically says which combination we're looking at. This should correspond
-		##to the order and number of one_repeated_inds.index(one_repeated_ind)
-		match_ind = matches.index(match)
-		probs_values.append(float(match.split()[-1]))
+		probs_values.append(match.prob)
 		##Fails if lower than the low_prob threshold
-		if float(match.split()[-1])<high_prob:
+		if match.prob<high_prob:
 			probs_test.append('no')
 		else:
 			probs_test.append('yes')
@@ -771,12 +858,11 @@ def matches_retained(src_all,matches):
 	accepted_matches = []
 	accepted_inds = []
 	accepted_probs = []
-	for match in matches:
-		match_ind = matches.index(match)
+	for match_ind,match in enumerate(matches):
 		##If match is a likely combination, or no source is in the no_name blacklist, accept match
-		if probs_test[match_ind]=='yes' or len([name for name in no_names if name in match])==0:
-			accepted_matches.append(match.split())
-			accepted_probs.append(float(match.split()[-1]))
+		if probs_test[match_ind]=='yes' or len([name for name in no_names if name in match.names])==0:
+			accepted_matches.append(match)
+			accepted_probs.append(match.prob)
 		else:
 			pass
 	
@@ -788,7 +874,7 @@ def matches_retained(src_all,matches):
 	for match in accepted_matches:
 		for name in repeat_names:
 			name_ind = repeated_inds[repeat_names.index(name)]
-			if (name in match) and (name_ind not in accepted_inds): accepted_inds.append(name_ind)
+			if (name in match.names) and (name_ind not in accepted_inds): accepted_inds.append(name_ind)
 			
 	accepted_inds = list(np.sort(accepted_inds))
 	
@@ -798,8 +884,7 @@ def matches_retained(src_all,matches):
 	g_stats.num_high_prob = len([prob for prob in probs_values if probs_values<low_prob])
 	g_stats.num_close = len([test for test in probs_test if test=='yes'])
 	
-	##Calculate the residuals of each accepted match. We have alread .split()
-	##each match, so no need to do again when entering into calculate_resids
+	##Calculate the residuals of each accepted match
 	jstats,params,bses,chi_reds = calculate_resids(accepted_matches)
 	
 	return num_repeated_cats,accepted_matches,accepted_inds,accepted_probs,jstats,chi_reds,g_stats
@@ -20,7 +20,7 @@ parser.add_option('-c', '--cat_freqs',
 	help='Enter number of frequencies in each catalogue')
 	
 parser.add_option('-i', '--input_bayes', 
-	help='Enter name of input matched bayes')
+	help='Enter name of input matched bayes (a text file or group store)')
 
 parser.add_option('-o', '--prob_thresh',
 	help='The lower and upper probability thresholds - separate with a comma')
@@ -147,7 +147,7 @@ mkl.jstat_thresh = jstat_thresh
 mkl.num_freqs = num_freqs
 mkl.split = split
 
-def do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i):
+def do_plot(group,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i):
 	##Work out how many cataloges are present
 	present_cats = [cat for cat in src_all.cats if cat!='-100000.0']
 	num_matches = len(set(present_cats))
@@ -164,22 +164,22 @@ def do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_tes
 			if plot_all:
 				if plot_num_catalogues == 0:
 					if plot_num_combs == 0:
-						pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+						pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 						i+=1
 					else:
 						if num_combs == plot_num_combs: 
-							pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+							pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 							i+=1
 						else:
 							pass
 				else:
 					if num_matches == plot_num_catalogues:
 						if plot_num_combs == 0:
-							pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+							pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 							i+=1
 						else:
 							if num_combs == plot_num_combs: 
-								pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+								pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 								i+=1
 							else:
 								pass
@@ -188,22 +188,22 @@ def do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_tes
 				if truth_test:
 					if plot_num_catalogues == 0:
 						if plot_num_combs == 0:
-							pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+							pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 							i+=1
 						else:
 							if num_combs == plot_num_combs: 
-								pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+								pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 								i+=1
 							else:
 								pass
 					else:
 						if num_matches == plot_num_catalogues:
 							if plot_num_combs == 0:
-								pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+								pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 								i+=1
 							else:
 								if num_combs == plot_num_combs: 
-									pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+									pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 									i+=1
 								else:
 									pass
@@ -212,7 +212,7 @@ def do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_tes
 		else:
 			for query in queries:
 				if query in src_all.names: 
-					pol.create_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit)
+					pol.create_plot(bayes_comp.text(group),accepted_inds,match_crit,dom_crit,comb_crit)
 					i+=1
 				else: 
 					pass
@@ -221,33 +221,33 @@ def do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_tes
 	return i
 	
 			
-def plot_accept_type(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,accept_type,i):
+def plot_accept_type(group,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,accept_type,i):
 	##If certain types of matches are requested, only plot the correct type of match
 	if plot_types:
 		if p_position:
-			if accept_type == 'position': i = do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
+			if accept_type == 'position': i = do_plot(group,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
 		if p_spectral:
-			if accept_type == 'spectral': i = do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
+			if accept_type == 'spectral': i = do_plot(group,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
 		if p_combine:
-			if accept_type == 'combine': i = do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
+			if accept_type == 'combine': i = do_plot(group,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
 		if p_split:
-			if accept_type == 'split': i = do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
+			if accept_type == 'split': i = do_plot(group,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
 	##Otherwise, plot all types of matches
 	else:
-		i = do_plot(comp,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
+		i = do_plot(group,accepted_inds,match_crit,dom_crit,comb_crit,num_combs,truth_test,src_all,i)
 	return i
 
-def single_match_test(src_all,comp,accepted_matches,accepted_inds,g_stats,num_matches,repeated_cats,matches,i):
+def single_match_test(src_all,group,accepted_matches,accepted_inds,g_stats,num_matches,repeated_cats,matches,i):
 	'''Takes a combination of sources, one from each catalogue, with positional probabilities,
 	and determines whether they are a match or not - Algorithm 2 in the write up'''
 	match = accepted_matches[0]
-	prob = float(match[-1])
+	prob = match.prob
 	##calculate_resids needs a list of matches - calculate parameters
 	jstat_resids,params,bses,chi_resids = mkl.calculate_resids([match])
-	src_g = mkl.get_srcg(match)
+	src_g = match
 	
 	##Play the prob trick again to work out which match has been accepted
-	match_probs = [float(m.split()[-1]) for m in matches]
+	match_probs = [m.prob for m in matches]
 	dom_num = match_probs.index(prob)+1
 	match_crit = "Combination (%d)\npossible\n%s repeated cats" %(dom_num,repeated_cats)
 	
@@ -286,38 +286,24 @@ def single_match_test(src_all,comp,accepted_matches,accepted_inds,g_stats,num_ma
 	
 	##If prob is higher than threshold, ignore position of sources and accept the match
 	if prob>high_prob:
-		i = plot_accept_type(comp,accepted_inds,match_crit,'N/A','Pos. accepted\nby $P>P_u$',num_matches,plot_accept,src_all,'position',i)
+		i = plot_accept_type(group,accepted_inds,match_crit,'N/A','Pos. accepted\nby $P>P_u$',num_matches,plot_accept,src_all,'position',i)
 	else:
 		##look to see if all sources are within the resolution of the
 		##base catalogue or above some probability theshold, if so check with a spec test else reject them
 		if close_test=='passed' or prob>low_prob:  
 			##IF below either threshold, append with the applicable fit label
 			if jstat_resids[0]<=jstat_thresh or chi_resids[0]<=chi_thresh:
-				i = plot_accept_type(comp,accepted_inds,match_crit,'Spec. passed','Accept by spec',num_matches,plot_accept,src_all,'spectral',i)
+				i = plot_accept_type(group,accepted_inds,match_crit,'Spec. passed','Accept by spec',num_matches,plot_accept,src_all,'spectral',i)
 			else:
-				i = plot_accept_type(comp,accepted_inds,match_crit,'Spec. failed','Reject by spec',num_matches,plot_reject,src_all,'spectral',i)
+				i = plot_accept_type(group,accepted_inds,match_crit,'Spec. failed','Reject by spec',num_matches,plot_reject,src_all,'spectral',i)
 		else:
-			i = plot_accept_type(comp,accepted_inds,match_crit,'N/A','pos reject by $P<P_l$',num_matches,plot_reject,src_all,'position',i)
+			i = plot_accept_type(group,accepted_inds,match_crit,'N/A','pos reject by $P<P_l$',num_matches,plot_reject,src_all,'position',i)
 	return i
 
-def make_plots(comp,i):
-	##Get the information into nice usable forms, and get rid of empty/pointless
-	##entries
-	chunks = comp.split('START_COMP')
-	all_info = chunks[0].split('\n')
-	
-	##FOR SOME REASON CAN'T DO BOTH OF THESE LINES IN THE SAME FOR LOOP?!?!?!
-	for entry in all_info:   
-		if entry=='': del all_info[all_info.index(entry)]
-	for entry in all_info:
-		if 'START' in entry: del all_info[all_info.index(entry)]
-
-	matches = chunks[1].split('\n')
-	del matches[0],matches[-2:]
-	
-	##Put the information for every source in the matched group in one source_group() class
-	##(see apply_criteria_lib for source_group())
-	src_all = mkl.get_allinfo(all_info)
+def make_plots(group,src_all,matches,i):
+	##The information for every source in the matched group comes in one source_group() class,
+	##and for every combination in a list of them (see make_table_lib for source_group()).
+	##The text of the group is only needed if it gets plotted
 	
 	##This line applies positional criteria, and tells us if a simple one catalogue repeat source, returning
 	##how many combinations are possible and statistics on them
@@ -326,11 +312,11 @@ def make_plots(comp,i):
 	
 	##If no combinations are possible, reject all info (goes into the eyeball document)
 	if len(accepted_matches)==0:
-		i = plot_accept_type(comp,accepted_inds,match_crit,'Positionally\nimpossible','N/A',len(matches),plot_reject,src_all,'position',i)
+		i = plot_accept_type(group,accepted_inds,match_crit,'Positionally\nimpossible','N/A',len(matches),plot_reject,src_all,'position',i)
 		
 	##If just one combo positionally possible, do a single combo check
 	elif len(accepted_matches)==1:
-		i = single_match_test(src_all,comp,accepted_matches,accepted_inds,g_stats,len(matches),repeated_cats,matches,i)
+		i = single_match_test(src_all,group,accepted_matches,accepted_inds,g_stats,len(matches),repeated_cats,matches,i)
 		##(Any plotting gets done within single_match_test)
 		
 	##If more than one combination is positionally possible:
@@ -340,16 +326,16 @@ def make_plots(comp,i):
 		num_cat = len(set([cat for cat in src_all.cats if cat!='-100000.0']))
 		
 		dom_source = mkl.spec_pos_agree(jstats,chi_reds,accepted_probs,num_cat)
-		src_g = mkl.get_srcg(accepted_matches[0])
+		src_g = accepted_matches[0]
 		##If it finds a dominant source, accept it - counts as a spectral match 
 		if dom_source!='none':
 			jstat_resids,params,bses,chi_resids = mkl.calculate_resids([accepted_matches[dom_source]])
 			##Find the probs of all the matches, and use the prob of the dom match to see what number match was accepted
-			all_probs = [float(match.split()[-1]) for match in matches]
+			all_probs = [match.prob for match in matches]
 			accepted_prob = accepted_probs[dom_source]
 			dom_num = all_probs.index(accepted_prob)
 			
-			i = plot_accept_type(comp,accepted_inds,match_crit,'Dom source (%d)' %(dom_num+1),'Accept dom.\nsource',len(matches),plot_accept,src_all,'spectral',i)
+			i = plot_accept_type(group,accepted_inds,match_crit,'Dom source (%d)' %(dom_num+1),'Accept dom.\nsource',len(matches),plot_accept,src_all,'spectral',i)
 			
 		##If nothing dominates, send to check if a combined source works
 		else:
@@ -361,27 +347,28 @@ def make_plots(comp,i):
 				accept_type = 'combine'
 			##Plot the combine or split, based on whether accepted or retained to investigate
 			if 'Accepted' in comb_crit:
-				i = plot_accept_type(comp,accepted_inds,match_crit,'No dom. source',comb_crit,len(matches),plot_accept,src_all,accept_type,i)
+				i = plot_accept_type(group,accepted_inds,match_crit,'No dom. source',comb_crit,len(matches),plot_accept,src_all,accept_type,i)
 			else:
-				i = plot_accept_type(comp,accepted_inds,match_crit,'No dom. source',comb_crit,len(matches),plot_eyeball,src_all,accept_type,i)
+				i = plot_accept_type(group,accepted_inds,match_crit,'No dom. source',comb_crit,len(matches),plot_eyeball,src_all,accept_type,i)
 	return i
 				
 				
 ##Open the input text file (output from calculate_bayes.py)
-bayes_comp = open(options.input_bayes).read().split('END_GROUP')
-del bayes_comp[-1]
+##This can also be a group store written with calculate_bayes.py --store, which is
+##read straight from its columns
+bayes_comp = mkl.bayes_groups(options.input_bayes)
 
 if save_plots:
 	try:
 		plot_lim = int(save_plots)
 		i = 0
-		for comp in bayes_comp:
-			if i < plot_lim: i = make_plots(comp,i)
+		for group,src_all,matches in bayes_comp:
+			if i < plot_lim: i = make_plots(group,src_all,matches,i)
 	except ValueError:
-		for comp in bayes_comp: i = make_plots(comp,0)
+		for group,src_all,matches in bayes_comp: i = make_plots(group,src_all,matches,0)
 	
 else:
-	for comp in bayes_comp: i = make_plots(comp,0)
+	for group,src_all,matches in bayes_comp: i = make_plots(group,src_all,matches,0)
 	
 
 
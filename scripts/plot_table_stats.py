@@ -1,15 +1,11 @@
 #!/usr/bin/python
-from astropy.io.votable import parse as vot_parse
-try:
-	import pyfits as fits
-except ImportError:
-	from astropy.io import fits
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import rc
 import optparse
 from statsmodels.robust.scale import mad
 import statsmodels.api as sm
+import table_access_lib as tal
 
 parser = optparse.OptionParser()
 
@@ -32,14 +28,8 @@ class source_info:
 
 name = options.input_table
 
-if '.vot' in name:
-	table = vot_parse(name,pedantic=False).get_first_table()
-	tdata = table.array
-elif '.fits' or '.FITS' in name:
-	table = fits.open(name,pedantic=False)
-	tdata = table[1].data
-else:
-	sys.exit('Entered table must either be VOTable or FITS')
+##Only the columns used below are read from the table
+tdata = tal.open_table(name)
 
 SIs = tdata['SI']
 intercepts = tdata['Intercept']
@@ -50,6 +40,7 @@ num_cats = tdata['Number_cats']
 #retained_matches = tdata['Retained_matches']
 type_matches = tdata['Match_stage']
 low_resids = tdata['Low_resids']
+print tal.bytes_report()
 
 def make_source(ind):
 	source=source_info()
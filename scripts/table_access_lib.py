@@ -0,0 +1,127 @@
+#!/usr/bin/python
+import numpy as np
+import os
+import sys
+from astropy.io.votable import parse as vot_parse
+try:
+	import pyfits as fits
+except ImportError:
+	from astropy.io import fits
+
+##Every table opened by name through open_table, so a file is only ever opened
+##once per run, and any column already read from it is never read again
+open_tables = {}
+
+class fits_table:
+	'''A FITS table opened with memmap. Nothing is read from disk until a column is asked
+	for, and each column is kept once read. bytes_used adds up the size of every column
+	used, over the rows used, out of the total_bytes in the table. It is not a measure of
+	what actually came off disk - memmap reads whole pages, and the OS may have them cached'''
+	def __init__(self,name,infile=None,hdu=1):
+		self.name = name
+		if infile is None: infile = name
+		self.hdulist = fits.open(infile,memmap=True)
+		self.hdu = self.hdulist[hdu]
+		self.header = self.hdu.header
+		self.names = list(self.hdu.columns.names)
+		self.rows = self.header['NAXIS2']
+		self.shape = (self.rows,)
+		self.total_bytes = self.header['NAXIS1']*self.rows
+		self.bytes_used = 0
+		self.columns = {}
+
+	def __len__(self):
+		return self.rows
+
+	def __getitem__(self,key):
+		'''A column name returns that column. Anything else (e.g. a slice) returns
+		a table_slice, which reads columns for just those rows'''
+		if isinstance(key,basestring):
+			return self.column(key)
+		return table_slice(self,key)
+
+	def column_bytes(self,col_name,rows):
+		'''The number of bytes a column takes up on disk over rows rows'''
+		return self.hdu.columns[col_name].dtype.itemsize*rows
+
+	def column(self,col_name):
+		'''Reads a single column, or returns it if already read'''
+		if col_name not in self.columns:
+			self.columns[col_name] = np.array(self.hdu.data.field(col_name))
+			self.bytes_used += self.column_bytes(col_name,self.rows)
+		return self.columns[col_name]
+
+class table_slice:
+	'''Some of the rows of a fits_table, e.g. one chunk. Columns are read for just
+	those rows, and kept only as long as the slice is'''
+	def __init__(self,table,key):
+		self.table = table
+		self.data = table.hdu.data[key]
+		self.rows = len(self.data)
+		self.shape = (self.rows,)
+		self.columns = {}
+
+	def __len__(self):
+		return self.rows
+
+	def __getitem__(self,col_name):
+		if col_name not in self.columns:
+			self.columns[col_name] = np.array(self.data.field(col_name))
+			self.table.bytes_used += self.table.column_bytes(col_name,self.rows)
+		return self.columns[col_name]
+
+class array_table:
+	'''Gives a table already in memory (a VOTable, or anything else that can only be
+	read whole) the same columns as a fits_table'''
+	def __init__(self,name,data,header={},total_bytes=None):
+		self.name = name
+		self.data = data
+		self.header = header
+		self.names = list(data.dtype.names)
+		self.rows = len(data)
+		self.shape = (self.rows,)
+		if total_bytes is None: total_bytes = data.nbytes
+		self.total_bytes = total_bytes
+		##It all had to be read in to get here
+		self.bytes_used = total_bytes
+		self.columns = {}
+
+	def __len__(self):
+		return self.rows
+
+	def __getitem__(self,key):
+		if isinstance(key,basestring):
+			return self.column(key)
+		return self.data[key]
+
+	def column(self,col_name):
+		if col_name not in self.columns:
+			self.columns[col_name] = self.data[col_name]
+		return self.columns[col_name]
+
+def open_table(name,infile=None):
+	'''Opens a FITS table or VOTable, working out which from name. infile can be given
+	as an open file-like object to read instead of name (e.g. a table out of an archive).
+	Tables opened by name are kept, so opening the same file again costs nothing.
+	If not the right format, exit the whole process'''
+	if infile is None and name in open_tables:
+		return open_tables[name]
+	if '.vot' in name:
+		if infile is None: infile = name
+		data = vot_parse(infile,pedantic=False).get_first_table().array
+		total_bytes = None
+		if isinstance(infile,basestring): total_bytes = os.path.getsize(infile)
+		table = array_table(name,data,total_bytes=total_bytes)
+	elif '.fits' in name or '.FITS' in name:
+		table = fits_table(name,infile)
+	else:
+		sys.exit('Entered table must either be VOTable or FITS')
+	if infile is None or isinstance(infile,basestring): open_tables[name] = table
+	return table
+
+def bytes_report():
+	'''Returns a summary of the column bytes used from every table opened by name. Rows
+	used more than once (e.g. by a chunk after the whole column) are counted each time'''
+	used = sum([table.bytes_used for table in open_tables.values()])
+	total = sum([table.total_bytes for table in open_tables.values()])
+	return 'Column bytes used: %.2f of %.2f MB from %d tables' %(used/1024.0**2,total/1024.0**2,len(open_tables))